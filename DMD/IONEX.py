@@ -7,7 +7,9 @@ import re
 import pandas as pd
 import subprocess
 import os
+import ftplib
 from ftplib import FTP_TLS
+import queue
 # import platform
 import cdflib
 import glob
@@ -34,6 +36,18 @@ logging.basicConfig(level=logging.INFO)
 
 # from DMD.utilities import algorithms_dmd
 import DMD.algorithms_dmd as dmd
+from DMD.ionex_parser import read_ionex, IonexFile
+from DMD.map_cache import cached_ionex_maps
+from DMD.map_ingest import ingest_maps, fill_from_previous
+from DMD.map_sampler import sample_ionex
+from DMD.cdf_archive import CDFCube, cdf_files, CACHE_DAYS
+from DMD.map_store import MapStore, MAP_STORE_NAME
+from DMD.online_dmd import StreamingDMD, DMD_STATE_NAME, STREAMING_RANK
+from DMD.dmd_batch import predict_windows, DMD_WORKERS
+from utilities.product_index import ProductIndex
+from utilities.telemetry import telemetry_run
+from utilities.throttle import host_slot_sync, host_stats, backoff_delay, NETWORK_ERRORS
+from utilities.network import fetch_and_decompress, decompress_file, download_files, resolve_prioritized_files, MAX_CONCURRENT_DOWNLOADS
 
 AGENCIES : List[str] = ['IGS','JPL','ESA','COD']
 OLD_AGENCIES_PRIORITY : List[str] = ['igs','jpl','upc','igr','jpr','upr']
@@ -45,6 +59,14 @@ RMS_MAP_DIM = (13,71,73)
 CODE_PREDICTED_NAMES = ['c1p','c2p']
 
 MAX_PROCESSES = cpu_count() // 2
+
+FTPS_HOST = 'gdc.cddis.eosdis.nasa.gov'
+FTPS_USER = 'anonymous'
+FTPS_PASSWD = '1234@gmail.com'
+FTPS_WORKERS = 5                    # logged in connections of IONEX.download_ionex(run_async=True)
+FTPS_ATTEMPTS = 2
+# failures that count against the host, a missing file (error_perm) does not
+FTPS_TRANSIENT_ERRORS = (ftplib.error_temp, ftplib.error_reply, ftplib.error_proto, EOFError) + NETWORK_ERRORS
 VERIFY_REST_SECURITY = True
 
 #https://notebook.community/daniestevez/jupyter_notebooks/IONEX
@@ -98,9 +120,26 @@ def date_to_doy(date):
 
 class IONEXv2(object):
 
-	def __init__(self, save_directory, n_prior_days = 120):
+	def __init__(self, save_directory, n_prior_days = 120, use_map_store = False, keep_compressed = False, dmd_options = None, streaming_dmd = False, dtype = np.float64):
 		self.directory = save_directory
 		self.n_prior_days = n_prior_days
+		# SVD backend, rank and forecast method of the prediction, e.g. {'svd':'randomized','energy':0.999} (see dmd.DMD_prediction)
+		self.dmd_options = dmd_options or {}
+		# RMS products stay .gz/.Z on disk, the readers decompress them in memory
+		self.keep_compressed = keep_compressed
+		os.makedirs(self.directory, exist_ok=True)
+		self.index = ProductIndex(self.directory)
+		# RMS windows come from one consolidated HDF5 file instead of the daily files
+		self.map_store = MapStore(os.path.join(self.directory, MAP_STORE_NAME)) if use_map_store else None
+		# the DMD window is kept in DMD_STATE_NAME and slid by one day per run instead of recomputed
+		self.streaming_dmd = streaming_dmd
+		# precision of the RMS windows, the DMD and the predicted maps. np.float32 halves the cube
+		# and the randomized / snapshots / streaming working sets; the exact SVD gains nothing from it
+		self.dtype = dtype
+		svd = self.dmd_options.get('svd', 'randomized' if streaming_dmd else 'exact')
+		if np.dtype(dtype) == np.float32 and svd == 'exact':
+			logging.warning('float32 with the exact SVD: numpy\'s float32 SVD is no faster and peaks higher than float64, '
+				'use dmd_options={\'svd\':\'randomized\'} or \'snapshots\' for the memory savings')
 
     ##################################################
     #      #
@@ -133,8 +172,8 @@ class IONEXv2(object):
 		return zip_names,names
 	
 
-	def predict_dmd_map(self,current_date,check_priority_files = True,debug = False):
-		
+	def _get_predicted_code_files(self,current_date):
+
 		predicted_code_files = []
 		for _name in CODE_PREDICTED_NAMES:
 			logging.info(f'Checking {_name.upper()} for {current_date}')
@@ -160,7 +199,10 @@ class IONEXv2(object):
 		# 		required_c2p_file = self._get_c1p_file_name(current_date)
 		# 		raise Exception(f'{os.path.basename(required_c2p_file)} CAN\'T BE DOWNLOADED!')
 
-		delayed_date_range = [current_date - datetime.timedelta(days=1) * i for i in range(1,self.n_prior_days+1)]
+		return predicted_code_files
+
+	def _update_rms_products(self,delayed_date_range,check_priority_files = True):
+
 		missing_dates = []
 		updated_dates = []
 		logging.info(f'Checking RMS products from {delayed_date_range[0]} to {delayed_date_range[-1]}')
@@ -170,8 +212,9 @@ class IONEXv2(object):
 			if not rms_product:
 				missing_dates.append(delayed_date)
 			elif check_priority_files:
-				_,priorotize_products = self._get_prioritized_list_of_products(delayed_date)
+				priorotize_zip_products,priorotize_products = self._get_prioritized_list_of_products(delayed_date)
 				rms_product_name = rms_product.split(os.sep)[-1]
+				if rms_product_name not in priorotize_products: priorotize_products = priorotize_zip_products
 				priority_index = priorotize_products.index(rms_product_name)
 				if priority_index > 0:
 					updated_dates.append(delayed_date)
@@ -187,7 +230,29 @@ class IONEXv2(object):
 			results = self.download_ionex_by_date_list(updated_dates)
 			logging.info(f'Done Downloading {len(results)} prioritized RMS products!')
 
-		list_of_rms_products = [self._check_rms_product_availability(delayed_date) for delayed_date in delayed_date_range] 
+		return [self._check_rms_product_availability(delayed_date) for delayed_date in delayed_date_range]
+
+	def _save_dmd_products(self,pred_maps,predicted_code_files):
+
+		created_files = []
+		for cod_file,cod_name in zip(predicted_code_files,CODE_PREDICTED_NAMES):
+			if cod_file is None: continue
+			dmd_file = dmd_rms_ionex(cod_file_path=cod_file,
+				 		  dmd_predicted_maps=pred_maps,
+						  _replace=cod_name,
+						#   _save_location = os.path.join(self.directory,'..','products'))
+						_save_location = os.path.join(self.directory))
+			created_files.append(dmd_file)
+		return created_files
+
+	def predict_dmd_map(self,current_date,check_priority_files = True,debug = False):
+		
+		self.index.refresh()
+
+		predicted_code_files = self._get_predicted_code_files(current_date)
+
+		delayed_date_range = [current_date - datetime.timedelta(days=1) * i for i in range(1,self.n_prior_days+1)]
+		list_of_rms_products = self._update_rms_products(delayed_date_range,check_priority_files)
 
 		# TODO implement dmd prediction c1p + c2p
 
@@ -197,49 +262,120 @@ class IONEXv2(object):
 			n_pred_days += 1
 
 		logging.info(f'Executing DMD...,#{n_pred_days} days prediction')
-		rms_maps = self.get_numpy_rmsmaps(list_of_rms_products)
-		pred_maps = dmd.DMD_prediction(rms_maps,n_pred_days=n_pred_days)
+		if self.streaming_dmd:
+			pred_maps = self._streaming_dmd_prediction(list_of_rms_products,n_pred_days)
+		else:
+			rms_maps = self.get_numpy_rmsmaps(list_of_rms_products)
+			pred_maps = dmd.DMD_prediction(rms_maps,n_pred_days=n_pred_days,**self.dmd_options)
 		# print(predicted_code_files)
 		logging.info(f'Saving files...')
 
-		created_files = []
-		for cod_file,cod_name in zip(predicted_code_files,CODE_PREDICTED_NAMES):
-			if cod_file is None: continue
-			dmd_file = dmd_rms_ionex(cod_file_path=cod_file,
-				 		  dmd_predicted_maps=pred_maps,
-						  _replace=cod_name,
-						#   _save_location = os.path.join(self.directory,'..','products'))
-						_save_location = os.path.join(self.directory))
-			created_files.append(dmd_file)
+		created_files = self._save_dmd_products(pred_maps,predicted_code_files)
+		self.index.add(created_files)
 		logging.info(f'Done!')
 		
 		return created_files
-	
-	def get_numpy_rmsmaps(self,files_path):
 
-		result = np.zeros((0,*RMS_MAP_DIM))
-		for file_name in files_path:
-			try:
-				np_tmap = np.array(self._get_rmsmaps(file_name))
-				# print(file_name,np.max(np_tmap))
-				if np.max(np_tmap) > 998:
-					raise FileNotFoundError("Values exiding 999!")
-			except Exception as e:
-				# print(e,file_name,'Appending previous file')
-				if result.shape[0] > 0:
-					result = np.concatenate((np.expand_dims(result[0],0),result))
+	def predict_dmd_maps(self,dates,check_priority_files = True,workers = DMD_WORKERS,debug = False):
+		'''
+		predict_dmd_map for many target dates in one pass. The RMS products of the union of
+		their windows are checked and downloaded once, loaded once into one newest first cube,
+		and every date's window is a slice of it; the windows are predicted in parallel
+		(consecutive dates slide one StreamingDMD with streaming_dmd, see dmd_batch) and all
+		c1p/c2p_dmd_rms products are written at the end. Returns {date: created files}.
+		'''
+		self.index.refresh()
+		dates = sorted(set(dates))
+
+		predicted_code_files = {date: self._get_predicted_code_files(date) for date in dates}
+
+		# newest day first, the window of a date is n_prior_days consecutive slots
+		newest_date = dates[-1] - datetime.timedelta(days=1)
+		n_slots = (dates[-1] - dates[0]).days + self.n_prior_days
+		delayed_date_range = [newest_date - datetime.timedelta(days=1) * i for i in range(n_slots)]
+		list_of_rms_products = self._update_rms_products(delayed_date_range,check_priority_files)
+
+		windows = []
+		for date_index,date in enumerate(dates):
+			start = (dates[-1] - date).days
+			n_pred_days = 1
+			for p in list_of_rms_products[start:start+self.n_prior_days]:
+				if not p is None: break
+				n_pred_days += 1
+			windows.append((date_index,start,n_pred_days))
+
+		logging.info(f'Loading {n_slots} days of RMS maps for {len(dates)} dates')
+		if self.map_store is not None:
+			cube, ok = self.map_store.maps(list_of_rms_products, 'RMS', max_value=998, dtype=self.dtype)
+		else:
+			cube, ok = ingest_maps(list_of_rms_products, 'RMS', max_value=998, dtype=self.dtype)
+
+		logging.info(f'Executing DMD for {len(dates)} dates...')
+		predictions = predict_windows(cube, ok, windows, self.n_prior_days, self.dmd_options,
+						streaming=self.streaming_dmd, workers=workers, desc='DMD' if debug else None)
+		del cube
+
+		logging.info(f'Saving files...')
+		created_files = {}
+		for date_index,date in enumerate(dates):
+			if predictions[date_index] is None:
+				logging.info(f'No usable RMS products for {date}')
 				continue
-			if np_tmap.shape[0] > 13:
-				np_tmap = np_tmap[list(range(0,26,2)),:,:]
-			np_tmap = np_tmap.reshape(1,*RMS_MAP_DIM)
-			result = np.concatenate((np_tmap,result))
+			created_files[date] = self._save_dmd_products(predictions[date_index],predicted_code_files[date])
+		self.index.add([dmd_file for files in created_files.values() for dmd_file in files])
+		logging.info(f'Done!')
 
-		return result
+		return created_files
+	
+	def get_numpy_rmsmaps(self,files_path):
+		# newest file first, a missing or saturated (> 998) file repeats the one before it
+		if self.map_store is not None:
+			cube, ok = self.map_store.maps(files_path, 'RMS', max_value=998, dtype=self.dtype)
+		else:
+			cube, ok = ingest_maps(files_path, 'RMS', max_value=998, dtype=self.dtype)
+		first = fill_from_previous(cube, ok)
+		return cube[first:][::-1]
 		
+	def _rms_key(self,file_path):
+		# a product is the same day of the window while its name and mtime are
+		if file_path is None: return None
+		return '{}:{}'.format(os.path.basename(file_path), os.stat(file_path).st_mtime_ns)
+
+	def _streaming_dmd_prediction(self,files_path,n_pred_days):
+		# files_path newest first like get_numpy_rmsmaps, the model window is oldest first
+		state_path = os.path.join(self.directory, DMD_STATE_NAME)
+		options = dict(self.dmd_options)
+		method = options.pop('method', 'power')
+		keys = [self._rms_key(p) for p in files_path][::-1]
+		newest = len(keys)
+		while newest > 0 and keys[newest-1] is None: newest -= 1
+
+		model = StreamingDMD.load(state_path) if os.path.exists(state_path) else None
+		if model is not None and (model.needs_refit
+				or model.rank != options.get('rank', STREAMING_RANK)
+				or model.energy != options.get('energy')):
+			model = None
+
+		if model is not None and model.keys == keys[:newest]:
+			logging.info('DMD window unchanged')
+			return model.predict(n_pred_days, method)
+		if model is not None and len(model.keys) == newest and model.keys[1:] == keys[:newest-1]:
+			cube, ok = ingest_maps([files_path[len(keys)-newest]], 'RMS', max_value=998, dtype=self.dtype)
+			if ok[0]:
+				logging.info('Sliding the DMD window by one day')
+				model.update(cube[0], key=keys[newest-1])
+				model.save(state_path)
+				return model.predict(n_pred_days, method)
+
+		logging.info('Fitting the DMD window')
+		rms_maps = self.get_numpy_rmsmaps(files_path)
+		model = StreamingDMD.fit(rms_maps, keys=keys[:len(rms_maps)], **options)
+		model.save(state_path)
+		return model.predict(n_pred_days, method)
+
 	def _get_rmsmaps(self,filename):
-		with open(filename) as f:
-			ionex = f.read()
-			return [self._parse_rms(t) for t in ionex.split('START OF RMS MAP')[1:]]
+		# (n_maps,71,73) array, from the .npy sidecar unless the product changed
+		return cached_ionex_maps(filename,'RMS')
 		
 	def _parse_rms(self,tecmap, exponent = -1):
 		tecmap = re.split('.*END OF RMS MAP', tecmap)[0]
@@ -248,23 +384,14 @@ class IONEXv2(object):
 	def _check_cod_avilability(self,date,_name='c1p'):
 
 		c1p_file = self._get_cod_file_name(date,_name)
-		c1p_files = glob.glob(os.path.join(self.directory,f'{_name}*.*i'))
-		c1p_file_names = [c1p for c1p in c1p_files if c1p_file in [os.path.basename(f) for f in c1p_files]]
-		is_c1p_exist = len(c1p_file_names) == 1
-
-		c1p = None if not is_c1p_exist else c1p_file_names[0]
-
-		return c1p
+		return self.index.path(c1p_file)
 	
 	def _check_rms_product_availability(self,delayed_date):
 
-		_,file_name_to_search = self._get_prioritized_list_of_products(delayed_date)
-		all_existing_files = glob.glob(os.path.join(self.directory,'*'))
-		all_existing_file_names = [os.path.basename(f) for f in all_existing_files]
-		candidate_files = [os.path.join(self.directory,candidate) for candidate in file_name_to_search if candidate in all_existing_file_names]
-		is_candidate_exit = len(candidate_files) >= 1
-
-		rms_product = None if not is_candidate_exit else candidate_files[0]
+		zip_names,file_names = self._get_prioritized_list_of_products(delayed_date)
+		# an extracted product or the compressed one, in priority order
+		file_name_to_search = [name for pair in zip(file_names,zip_names) for name in pair]
+		_,rms_product = self.index.first_available(file_name_to_search)
 
 		return rms_product
 	
@@ -279,39 +406,8 @@ class IONEXv2(object):
 			return url
 
 	def _download_and_save_file(self,url,file_path):
-		def download(url):
-			# filename = url.split('/')[-1]
-			
-			response = requests.head(url,verify=VERIFY_REST_SECURITY)
-			if response.status_code != 200:
-				# raise Exception('HTTP error ' + str(response.status_code) +" "+ str(url))
-				return None
-			n_attepts = 3
-			response = None
-			for n in range(n_attepts):
-				try:
-					response = requests.get(url,verify=VERIFY_REST_SECURITY)
-				except:
-					# print(f'Error downloading {url}')
-					pass
-				if response: break
-			if response is None: return None
-			buf = BytesIO()
-			for chunk in response.iter_content(chunk_size=1000):
-					buf.write(chunk)
-			return buf.getvalue()
-		
-		if os.path.isfile(file_path): return file_path
-		data_zipped = download(url)
-		if data_zipped is None: 
-			
-			return None
-
-		ephem_bytes = hatanaka.decompress(data_zipped)
-		with atomic_write(file_path, mode='wb', overwrite=True) as f:
-			f.write(ephem_bytes)
-
-		return file_path
+		# streams straight from the socket through the decompressor into file_path
+		return fetch_and_decompress(url,file_path,verify=VERIFY_REST_SECURITY)
 	
 	def download_cod(self,current_date,_name):
 
@@ -327,71 +423,58 @@ class IONEXv2(object):
 			# print(date,url)
 			cod = self._download_and_save_file(url,extracted_file_path)
 			if cod:
+				self.index.add(cod)
 				return cod
 			
-	def download_all_ionex_at_once(self, current_date, files_report = False,debug=False,run_async=False):
+	def _get_prioritized_candidates(self,date):
 
-		dates_list = [current_date - datetime.timedelta(days=1) * i for i in range(self.n_prior_days)]
+		zip_names,file_names = self._get_prioritized_list_of_products(date)
 
-		files_to_download_dict = {}
+		candidates = []
+		for zip_name,file_name in zip(zip_names,file_names):
 
-		for date in dates_list:
+			url = self._get_url_file_path(date,zip_name)
+			
+			extracted_file_path = os.path.join(self.directory,file_name)
+			os.makedirs(os.path.dirname(extracted_file_path), exist_ok=True)
 
-			zip_names,file_names = self._get_prioritized_list_of_products(date)
+			candidates.append((extracted_file_path,{'url':url,'date':date}))
 
-			for zip_name,file_name in zip(zip_names,file_names):
+		return candidates
 
-				url = self._get_url_file_path(date,zip_name)
-				
-				extracted_file_path = os.path.join(self.directory,file_name)
-				os.makedirs(os.path.dirname(extracted_file_path), exist_ok=True)
+	def download_all_ionex_at_once(self, current_date, files_report = False,debug=False,run_async=False,max_concurrency=MAX_CONCURRENT_DOWNLOADS):
 
-				if requests.head(url,verify=VERIFY_REST_SECURITY).status_code == 200:
-					files_to_download_dict[extracted_file_path] = {'url':url,'date':date}
-					break
+		dates_list = [current_date - datetime.timedelta(days=1) * i for i in range(self.n_prior_days)]
 
-				# if self._download_and_save_file(url,extracted_file_path):
-					# break
+		# all candidates of all dates are probed at once, the highest priority hit of each date wins
+		prioritized_candidates = [self._get_prioritized_candidates(date) for date in dates_list]
+		files_to_download_dict = resolve_prioritized_files(prioritized_candidates,verify=VERIFY_REST_SECURITY,max_concurrency=max_concurrency)
 
 		# TODO implement thread pool downloading
 		print(files_to_download_dict)
 		pass
 
-	def download_ionex_by_date_list(self,dates_list,files_report = False,debug=False):
-
-		files_to_download_dict = {}
-		for date in dates_list:
-			zip_names,file_names = self._get_prioritized_list_of_products(date)
+	@telemetry_run('download_ionex_by_date_list')
+	def download_ionex_by_date_list(self,dates_list,files_report = False,debug=False,max_concurrency=MAX_CONCURRENT_DOWNLOADS):
 
-			for zip_name,file_name in zip(zip_names,file_names):
-
-				url = self._get_url_file_path(date,zip_name)
-				
-				extracted_file_path = os.path.join(self.directory,file_name)
-				os.makedirs(os.path.dirname(extracted_file_path), exist_ok=True)
-
-				if requests.head(url,verify=VERIFY_REST_SECURITY).status_code == 200:
-					files_to_download_dict[extracted_file_path] = {'url':url,'date':date}
-					break
-
-				# if self._download_and_save_file(url,extracted_file_path):
-					# break
+		# all candidates of all dates are probed at once, the highest priority hit of each date wins
+		prioritized_candidates = [self._get_prioritized_candidates(date) for date in dates_list]
+		files_to_download_dict = resolve_prioritized_files(prioritized_candidates,verify=VERIFY_REST_SECURITY,max_concurrency=max_concurrency)
 
 		logging.info('Downloading Async...')
-		urls_to_download = [value['url'] for value in files_to_download_dict.values()]
-		pool = Pool(MAX_PROCESSES)
-		results = pool.starmap(self._download_and_save_file,zip(urls_to_download,list(files_to_download_dict.keys())))
-		pool.close()
-		pool.join()
+		results = download_files(files_to_download_dict,verify=VERIFY_REST_SECURITY,max_concurrency=max_concurrency,keep_compressed=self.keep_compressed)
+		self.index.add(results)
 		
 		return results
 
 
 class IONEX(object):
 
-	def __init__(self, save_directory , centre = 'esa'):
+	def __init__(self, save_directory , centre = 'esa', keep_compressed = False):
 		self.centre = centre
 		self.directory = save_directory
+		# only {year}/zip/*.Z is kept, the readers decompress it in memory
+		self.keep_compressed = keep_compressed
 	
 	def parse_map(self,tecmap, exponent = -1):
 		tecmap = re.split('.*END OF TEC MAP', tecmap)[0]
@@ -404,93 +487,61 @@ class IONEX(object):
 	def get_numpy_tecmaps(self,years_list,days_list):
 		if not type(days_list) == list: days_list = [days_list]
 		if not type(years_list) == list: years_list = [years_list]
-		result = None
-		file_names = []
-		# for year in tqdm(years_list,desc="Year",position=0, leave=True):
-		for year in years_list:
-			for day in tqdm(days_list,desc="Year : {}, Days : ".format(year),position=0, leave=True):
-				try:
-					file_name = self.ionex_local_path(year,day)
-					np_tmap = np.array(self.get_tecmaps(file_name))
-					file_names.append(file_name)
-				except Exception as e:
-					print(e,file_name)
-					continue
-				if np_tmap.shape[0] > 13:
-					np_tmap = np_tmap[list(range(0,26,2)),:,:]
-				d,h,w = np_tmap.shape
-				np_tmap = np_tmap.reshape(1,d,h,w)
-
-				#print(np_tmap.shape)
-				if result is None:
-					result = np_tmap.copy()
-				else:
-					result = np.vstack((result,np_tmap))
-				# print(result.shape)
-		return result,file_names
+		file_names = [self.ionex_product_path(year,day) for year in years_list for day in days_list]
+		cube, ok = ingest_maps(file_names, 'TEC', desc="Years : {}, Days : ".format(years_list))
+		for file_name in np.array(file_names)[~ok]:
+			print('Could not read',file_name)
+		if not np.any(ok):
+			return None,[]
+		file_names = [file_name for file_name, loaded in zip(file_names,ok) if loaded]
+		return (cube if np.all(ok) else cube[ok]),file_names
 
 	def get_numpy_rmsmaps(self,years_list,days_list):
 		if not type(days_list) == list: days_list = [days_list]
 		if not type(years_list) == list: years_list = [years_list]
-		result = None
-		file_names = []
-		# for year in tqdm(years_list,desc="Year",position=0, leave=True):
-		for year in years_list:
-			for day in tqdm(days_list,desc="Year : {}, Days : ".format(year),position=0, leave=True):
-				try:
-					file_name = self.ionex_local_path(year,day)
-					file_names.append(file_name)
-					np_tmap = np.array(self.get_rmsmaps(file_name))
-					# print(file_name,np.max(np_tmap))
-					if np.max(np_tmap) > 998:
-						raise FileNotFoundError("Values exiding 999!")
-				except Exception as e:
-					print(e,file_name,'Appending previous file : {}'.format(file_names[-2]))
-					f_idx = 2
-					while 1:
-						try:
-							file_name = file_names[-f_idx]
-							np_tmap = np.array(self.get_rmsmaps(file_name))
-							
-							if np.max(np_tmap) > 9998:
-								raise FileNotFoundError("Values exiding 999!")
-							break
-						except:
-							print(e,file_name,'Appending previous file : {}'.format(file_name))
-							f_idx+=1
-
-
-					# file_names.append(file_name)
-					# continue
-				if np_tmap.shape[0] > 13:
-					np_tmap = np_tmap[list(range(0,26,2)),:,:]
-				# print(file_name)
-				d,h,w = np_tmap.shape
-				np_tmap = np_tmap.reshape(1,d,h,w)
-
-				#print(np_tmap.shape)
-				if result is None:
-					result = np_tmap.copy()
-				else:
-					result = np.vstack((result,np_tmap))
-				# print(result.shape)
-		return result,file_names
-
-	def get_tecmaps(self,filename):
-		with open(filename) as f:
-			ionex = f.read()
-			return [self.parse_map(t) for t in ionex.split('START OF TEC MAP')[1:]]
-
-	def get_rmsmaps(self,filename):
-		with open(filename) as f:
-			ionex = f.read()
-			return [self.parse_rms(t) for t in ionex.split('START OF RMS MAP')[1:]]
+		file_names = [self.ionex_product_path(year,day) for year in years_list for day in days_list]
+		cube, ok = ingest_maps(file_names, 'RMS', max_value=998, desc="Years : {}, Days : ".format(years_list))
+		# missing or saturated (> 998) days repeat the previous day
+		first = fill_from_previous(cube, ok)
+		for file_name in np.array(file_names)[~ok]:
+			print('Could not read',file_name,'appending previous file')
+		if first == len(file_names):
+			return None,file_names
+		return cube[first:],file_names[first:]
+
+	def get_tecmaps(self,filename,epochs=None):
+		# (n_maps,71,73) array, one vectorized pass instead of parse_map per map
+		if epochs is None:
+			return cached_ionex_maps(filename,'TEC')
+		# only the maps of the requested epochs are parsed
+		with IonexFile(filename) as ionex:
+			return ionex.maps('TEC',epochs=epochs)
+
+	def get_rmsmaps(self,filename,epochs=None):
+		if epochs is None:
+			return cached_ionex_maps(filename,'RMS')
+		with IonexFile(filename) as ionex:
+			return ionex.maps('RMS',epochs=epochs)
 
 	def get_tec(self,tecmap, lat, lon):
 		i = round((87.5 - lat)*(tecmap.shape[0]-1)/(2*87.5))
 		j = round((180 + lon)*(tecmap.shape[1]-1)/360)
 		return tecmap[i,j]
 
+	def get_tec_at(self,filename,epoch,lat,lon):
+		'''
+		TEC of the map closest to epoch without parsing the rest of the file
+		'''
+		with IonexFile(filename) as ionex:
+			return self.get_tec(ionex.map('TEC',epoch),lat,lon)
+
+	def sample_maps(self,filename,times,lats,lons,kind='TEC',rotate=False):
+		'''
+		TEC/RMS at many (time, lat, lon) points at once, bilinear in space and linear in time
+		(see DMD.map_sampler.sample_maps)
+		'''
+		return sample_ionex(read_ionex(filename,kinds=(kind,)),times,lats,lons,kind,rotate)
+
 	def ionex_filename(self,year, day, zipped = True):
 		return '{}g{:03d}0.{:02d}i{}'.format(self.centre, day, year % 100, '.Z' if zipped else '')
 
@@ -510,6 +561,12 @@ class IONEX(object):
 	def ionex_local_path(self,year, day, zipped = False):
 		return os.path.join(self.directory,str(year),self.ionex_filename(year, day, zipped))
 
+	def ionex_product_path(self,year, day):
+		# the extracted file when there is one, the downloaded .Z otherwise
+		file_name = self.ionex_local_path(year,day)
+		if os.path.isfile(file_name): return file_name
+		return self._ionex_job(year,day)[1]
+
 	def create_dir_path(self,filename):
 		if not os.path.exists(os.path.dirname(filename)):
 			try:
@@ -517,122 +574,142 @@ class IONEX(object):
 			except OSError as exc: # Guard against race condition
 				pass
 	
-	# def download_single_ionex(self,year,day,ftps,files_report = False,debug=False):
-	def download_single_ionex(self,ftp_path,filename_zip,filename,files_report = False,debug=False):
-		# y=year
-		# d=day
-		# ftp_path = self.ionex_ftp_path(y, d)
-
-		# filename_zip = os.path.join(self.directory,str(y),'zip',self.ionex_filename(y, d))
-		# filename = os.path.join(self.directory,str(y),self.ionex_filename(y, d))[:-2]
-
+	def _ftps_login(self):
+		start = time.monotonic()
+		ftps = FTP_TLS(host = FTPS_HOST)
+		ftps.login(user=FTPS_USER, passwd=FTPS_PASSWD)
+		ftps.prot_p()
+		# the login round trips are the latency the host's limit adapts to
+		host_stats('ftps://{}'.format(FTPS_HOST)).observe_latency(time.monotonic() - start)
+		return ftps
+
+	def _ftps_close(self,ftps):
+		try:
+			ftps.quit()
+		except ftplib.all_errors:
+			ftps.close()
+
+	def _ionex_job(self,y,d):
+		ftp_path = self.ionex_ftp_path(y, d)
+		filename_zip = os.path.join(self.directory,str(y),'zip',self.ionex_filename(y, d))
+		filename = os.path.join(self.directory,str(y),self.ionex_filename(y, d))[:-2]
+		return ftp_path,filename_zip,filename
+
+	def _retrieve(self,ftps,ftp_path,filename_zip):
+		# an interrupted transfer must not look like a downloaded file
+		part_path = filename_zip + '.part'
+		try:
+			with open(part_path,'wb') as f:
+				ftps.retrbinary("RETR " + ftp_path, f.write)
+		except BaseException:
+			if os.path.isfile(part_path): os.remove(part_path)
+			raise
+		os.replace(part_path,filename_zip)
+
+	def fetch_single_ionex(self,ftps,ftp_path,filename_zip,filename,debug=False):
+		'''
+		Downloads ftp_path over a logged in connection (None logs in on demand) and
+		decompresses it in-process. Returns the connection to keep using, which is a
+		new one when the old one broke and None when logging in failed.
+		'''
 		self.create_dir_path(filename_zip)
-		self.create_dir_path(filename)
+		if not self.keep_compressed: self.create_dir_path(filename)
 
 		if not os.path.isfile(filename_zip) or os.path.getsize(filename_zip) < 1:
-			ftps = FTP_TLS(host = 'gdc.cddis.eosdis.nasa.gov')
-			ftps.login(user='anonymous', passwd='1234@gmail.com')
-			ftps.prot_p()
-			try:
-				os.remove(filename_zip)
-			except: pass
-			# if debug : 
 			logging.info('Downloading... : {}'.format(filename_zip))
-			try:
-				ftps.retrbinary("RETR " + ftp_path, open(filename_zip, 'wb').write)
-			except OSError as ose:
-				logging.info('OSError : {}, Another attempt!'.format(ose))
-				ftps.retrbinary("RETR " + ftp_path, open(filename_zip, 'wb').write)
-				pass
-			except Exception as ex:
-				logging.info('File Not Found {}: '.format(filename_zip),ex)
+			for attempt in range(FTPS_ATTEMPTS):
+				try:
+					# the workers share the host's adaptive slots and circuit breaker
+					with host_slot_sync('ftps://{}'.format(FTPS_HOST),FTPS_TRANSIENT_ERRORS):
+						if ftps is None: ftps = self._ftps_login()
+						self._retrieve(ftps,ftp_path,filename_zip)
+					break
+				except ftplib.error_perm as ex:
+					# e.g. 550, the file is not on the server but the connection is fine
+					logging.info('File Not Found {}: {}'.format(filename_zip,ex))
+					return ftps
+				except ftplib.all_errors as ex:
+					logging.info('{} : {}, Another attempt!'.format(type(ex).__name__,ex))
+					if ftps is not None: ftps.close()
+					ftps = None
+					if attempt < FTPS_ATTEMPTS - 1: time.sleep(backoff_delay(attempt))
+			else:
+				return ftps
 		else:
 			if debug : logging.info('{} exist!'.format(filename_zip))
 
-		if not os.path.isfile(filename):
+		if self.keep_compressed:
+			if debug : logging.info('Keeping {} compressed'.format(filename_zip))
+		elif not os.path.isfile(filename):
 			if debug : logging.info('Extracting... : {}, From : {}'.format(filename,filename_zip))
 			try:
-				subprocess.call(['7z', 'e', filename_zip,'-o'+os.path.dirname(filename)])
+				decompress_file(filename_zip,filename)
 			except Exception as ex:
 				logging.info('Couldn\'t Extract File : {}'.format(ex))
-			
-			# if platform.system() == 'Windows':
-			# 	subprocess.call(['7z', 'e', filename_zip,'-o'+os.path.dirname(filename)])
-			# else:
-			# 	subprocess.call(['gzip', '-d', filename])
 		else:
 			if debug : logging.info('{} exist!'.format(filename))
 
+		return ftps
 
-		ftps.close()
-
-
+	def download_single_ionex(self,ftp_path,filename_zip,filename,files_report = False,debug=False):
+		ftps = self.fetch_single_ionex(None,ftp_path,filename_zip,filename,debug)
+		if ftps is not None: self._ftps_close(ftps)
+
+	def _ionex_worker(self,jobs,debug=False):
+		# one logged in connection per worker, reused for every job it pulls
+		ftps = None
+		while True:
+			job = jobs.get()
+			try:
+				if job is None: break
+				ftps = self.fetch_single_ionex(ftps,*job,debug=debug)
+			except Exception as ex:
+				logging.info('Couldn\'t Download {} : {}'.format(job[0],ex))
+			finally:
+				jobs.task_done()
+		if ftps is not None: self._ftps_close(ftps)
 
-	def download_ionex(self, year, day, files_report = False,debug=False,run_async=False):
+	def download_ionex(self, year, day, files_report = False,debug=False,run_async=False,n_workers=FTPS_WORKERS):
 		if not type(year) == list:
 			year = [year]
 		if not type(day) == list:
 			day = [day]
 
-
-
-
 		if run_async:
 			format = "%(asctime)s: %(message)s"
 			logging.basicConfig(format=format, level=logging.INFO,
 					datefmt="%H:%M:%S")
-			thread_batch = 5
-			threads = []
+
+			# workers pull the next file as soon as they are done, no batch waits for its slowest file
+			jobs = queue.Queue()
 			for y in year:
 				for d in day:
-					
-					# x = threading.Thread(target=self.download_single_ionex, args=(y,d,ftps,files_report,debug,))
-
-					# y=year
-					# d=day
-					ftp_path = self.ionex_ftp_path(y, d)
-					filename_zip = os.path.join(self.directory,str(y),'zip',self.ionex_filename(y, d))
-					filename = os.path.join(self.directory,str(y),self.ionex_filename(y, d))[:-2]
-
-					x = threading.Thread(target=self.download_single_ionex, args=(ftp_path,filename_zip,filename,files_report,debug,))
-					x.start()
-					threads.append(x)
-					# self.download_single_ionex(y,d,files_report,debug)
-
-					if len(threads) > thread_batch:
-						for t in threads:
-							t.join()
-						logging.info('Batch of {} threads is DONE! Year {}, day {}'.format(thread_batch,y,d))
-						threads = []
-					
-
+					jobs.put(self._ionex_job(y, d))
+			n_jobs = jobs.qsize()
 
+			workers = [threading.Thread(target=self._ionex_worker, args=(jobs,debug,), daemon=True) for _ in range(max(1,min(n_workers,n_jobs)))]
+			for x in workers:
+				jobs.put(None)
+				x.start()
+			for x in workers:
+				x.join()
+			logging.info('{} files done by {} workers'.format(n_jobs,len(workers)))
 
 			return
 
-		ftps = FTP_TLS(host = 'gdc.cddis.eosdis.nasa.gov')
-		ftps.login(user='anonymous', passwd='1234@gmail.com')
-		ftps.prot_p()
+		ftps = self._ftps_login()
 
 		files_dict = {'file_path':[],'file_size':[]}
 
 		for y in year:
 			for d in day:
-				ftp_path = self.ionex_ftp_path(y, d)
-
-				filename_zip = os.path.join(self.directory,str(y),'zip',self.ionex_filename(y, d))
-				filename = os.path.join(self.directory,str(y),self.ionex_filename(y, d))[:-2]
-
-				self.create_dir_path(filename_zip)
-				self.create_dir_path(filename)
-
-				# print(ftps.size(ftp_path))
-
+				ftp_path,filename_zip,filename = self._ionex_job(y, d)
 
 				if files_report:
 					f_server_size = -1
 					try:
 						if debug: print(ftp_path)
+						if ftps is None: ftps = self._ftps_login()
 						f_server_size = ftps.size(ftp_path)
 					except Exception as e:
 						print('----',e)
@@ -643,39 +720,9 @@ class IONEX(object):
 					files_dict['file_path'].append(filename_zip)
 					files_dict['file_size'].append(f_server_size)
 
+				ftps = self.fetch_single_ionex(ftps,ftp_path,filename_zip,filename,debug)
 
-				if not os.path.isfile(filename_zip) or os.path.getsize(filename_zip) < 1:
-					try:
-						os.remove(filename_zip)
-					except: pass
-					if debug : print('Downloading... : ',filename_zip)
-					try:
-						ftps.retrbinary("RETR " + ftp_path, open(filename_zip, 'wb').write)
-					except OSError as ose:
-						print('OSError : {}, Another attempt!'.format(ose))
-						ftps.retrbinary("RETR " + ftp_path, open(filename_zip, 'wb').write)
-						pass
-					except Exception as ex:
-						print('File Not Found {}: '.format(filename_zip),ex)
-				else:
-					if debug : print(filename_zip,' exist!')
-
-				if not os.path.isfile(filename):
-					if debug : print('Extracting... : ',filename,', From : ',filename_zip)
-					try:
-						subprocess.call(['7z', 'e', filename_zip,'-o'+os.path.dirname(filename)])
-					except Exception as ex:
-						print('Couldn\'t Extract File : ',ex)
-					
-					# if platform.system() == 'Windows':
-					# 	subprocess.call(['7z', 'e', filename_zip,'-o'+os.path.dirname(filename)])
-					# else:
-					# 	subprocess.call(['gzip', '-d', filename])
-				else:
-					if debug : print(filename,' exist!')
-
-		ftps.close()
-
+		if ftps is not None: self._ftps_close(ftps)
 
 		if files_report:
 			df = pd.DataFrame.from_dict(files_dict)
@@ -705,28 +752,16 @@ class IONEX_CDF(object):
     	
 		self.directory = save_directory
 
-	def get_numpy_tecmaps(self,years_list):
-    		
-		days_array = []
-		
-		for year in years_list:
-    	
-			fpath = os.path.join(self.directory,str(year),'*.cdf')
-			cdf_files_list = glob.glob(fpath)
-
-			
-			cdf_files_list.sort()
-			for file in cdf_files_list:#,desc="CDF {} : ".format(fpath)):
-				# print(file)
-				cdf = cdflib.CDF(file)
-				# print(cdf.varget('lat'),cdf.varget('lon'))
+	def open_tecmaps(self,years_list,cache_days=CACHE_DAYS):
+		'''
+		Lazy (day, epoch, lat, lon) view of the years, days and epochs are read when sliced
+		'''
+		return CDFCube(cdf_files(self.directory,years_list),cache_days=cache_days)
 
-
-				days_array.append(cdf.varget('tecUQR'))
-				
-			
-		days_array = np.array(days_array)
-		return days_array
+	def get_numpy_tecmaps(self,years_list):
+		# one preallocated array filled file by file, no list of days copied afterwards
+		if len(cdf_files(self.directory,years_list)) == 0: return np.array([])
+		return np.asarray(self.open_tecmaps(years_list,cache_days=0))
 
 
 
@@ -1,26 +1,150 @@
 import numpy as np
 
-def DMD(X,Xprime,r=None,thr=1e-10):
-    
-    U,S,Vt = np.linalg.svd(X,full_matrices=False)
-    n_rows,n_cols = X.shape
-    if r is None:
-        r = np.sum(S > thr)
-    # r = int(np.ceil(r))
-    Ur = U[:,:r]
-    Sr = np.diag(S[:r])
-    Vtr = Vt[:r,:]
+SVD_THRESHOLD = 1e-10               # singular values below this are dropped whatever the rank settings
+RANDOMIZED_RANK = 200               # sketch size of the randomized backend when no max rank is given
+RANDOMIZED_OVERSAMPLING = 10
+RANDOMIZED_POWER_ITERATIONS = 2
+
+
+def select_rank(S, rank=None, energy=None, total_energy=None, thr=SVD_THRESHOLD):
+    '''
+    Number of singular values kept: those above thr, capped by rank and by the
+    smallest count whose squared sum reaches the energy fraction of total_energy
+    (sum of all squared singular values, the ones in S when not given)
+    '''
+    r = int(np.sum(S > thr))
+    if rank is not None:
+        r = min(r, int(rank))
+    if energy is not None:
+        # in double precision whatever the dtype of S, float32 sums would move the cut
+        S = np.asarray(S, np.float64)
+        if total_energy is None: total_energy = np.sum(S ** 2)
+        captured = np.cumsum(S ** 2) / total_energy
+        r = min(r, int(np.searchsorted(captured, energy)) + 1)
+    return max(r, 1)
+
+
+def _svd_exact(X, rank=None, energy=None, thr=SVD_THRESHOLD, **kwargs):
+    U, S, Vt = np.linalg.svd(X, full_matrices=False)
+    r = select_rank(S, rank, energy, thr=thr)
+    return U[:, :r], S[:r], Vt[:r, :]
+
+
+def _svd_randomized(X, rank=None, energy=None, thr=SVD_THRESHOLD, oversampling=RANDOMIZED_OVERSAMPLING,
+                    power_iterations=RANDOMIZED_POWER_ITERATIONS, seed=0, **kwargs):
+    '''
+    Halko, Martinsson & Tropp range finder: X is sketched with rank + oversampling random
+    columns, power iterations sharpen the spectrum, the SVD is then taken in that subspace
+    '''
+    n_rows, n_cols = X.shape
+    k = min(rank if rank is not None else RANDOMIZED_RANK, n_rows, n_cols)
+    rng = np.random.default_rng(seed)
+    # the same sketch for float32 and float64 X
+    Q, _ = np.linalg.qr(X @ rng.standard_normal((n_cols, min(k + oversampling, n_cols))).astype(X.dtype, copy=False))
+    for _ in range(power_iterations):
+        Q, _ = np.linalg.qr(X.T @ Q)
+        Q, _ = np.linalg.qr(X @ Q)
+    Ub, S, Vt = np.linalg.svd(Q.T @ X, full_matrices=False)
+    # the energy fraction is of the whole of X, not of the sketched part
+    r = select_rank(S, k, energy, total_energy=np.sum(X ** 2, dtype=np.float64), thr=thr)
+    return Q @ Ub[:, :r], S[:r], Vt[:r, :]
+
+
+def _svd_snapshots(X, rank=None, energy=None, thr=SVD_THRESHOLD, **kwargs):
+    '''
+    Method of snapshots: eigendecomposition of the (n_cols, n_cols) Gram matrix, cheap when
+    there are far fewer snapshots than grid points. Singular values below about
+    sqrt(machine epsilon) * S[0] are lost to the squaring.
+    '''
+    eigenvalues, V = np.linalg.eigh(X.T @ X)
+    order = np.argsort(eigenvalues)[::-1]
+    S = np.sqrt(np.clip(eigenvalues[order], 0, None))
+    V = V[:, order]
+    r = select_rank(S, rank, energy, thr=max(thr, S[0] * np.sqrt(np.finfo(X.dtype).eps)))
+    U = (X @ V[:, :r]) / S[:r]
+    return U, S[:r], V[:, :r].T
+
+
+SVD_BACKENDS = {
+    'exact': _svd_exact,
+    'randomized': _svd_randomized,
+    'snapshots': _svd_snapshots,
+}
+
+
+def truncated_svd(X, svd='exact', rank=None, energy=None, thr=SVD_THRESHOLD, **kwargs):
+    '''
+    (U, S, Vt) of the leading singular triplets of X with one of the SVD_BACKENDS.
+
+    rank caps the number of modes, energy (e.g. 0.999) keeps the fewest modes holding
+    that fraction of the squared Frobenius norm of X; kwargs go to the backend
+    (oversampling, power_iterations, seed for 'randomized').
+    '''
+    if svd not in SVD_BACKENDS:
+        raise ValueError('unknown SVD backend {}, one of {}'.format(svd, sorted(SVD_BACKENDS)))
+    return SVD_BACKENDS[svd](X, rank=rank, energy=energy, thr=thr, **kwargs)
+
+
+def dmd_operator(X,Xprime,r=None,thr=SVD_THRESHOLD,svd='exact',energy=None,**svd_kwargs):
+    '''
+    POD basis Ur and reduced operator Atilda of the DMD, without the modes
+    '''
+    Ur,S,Vtr = truncated_svd(X,svd,rank=r,energy=energy,thr=thr,**svd_kwargs)
+    Atilda = ((Ur.T @ Xprime) @ Vtr.T) / S
+    return Ur,Atilda
+
+
+def DMD(X,Xprime,r=None,thr=SVD_THRESHOLD,svd='exact',energy=None,**svd_kwargs):
+
+    Ur,S,Vtr = truncated_svd(X,svd,rank=r,energy=energy,thr=thr,**svd_kwargs)
+    r = len(S)
 
     Atilda = Ur.T @ Xprime @ Vtr.T @ np.diag(1.0/S[:r])
     W,Lambda = np.linalg.eig(Atilda)
     W = np.diag(W)
     Phi = Xprime @ Vtr.T @ np.diag(1.0/S[:r]) @ W
-    
-    return (Phi,Ur,Atilda,np.nan)
 
+    return (Phi,Ur,Atilda,np.nan)
 
-def DMD_prediction(maps,n_pred_days=1,n_daily_samples = 12):
 
+def reduced_forecast(A_tilda,a_tilda,n_steps,method='power'):
+    '''
+    (n_steps, r) reduced states A_tilda^k a_tilda for k = 1 .. n_steps, by repeated r x r
+    products ('power') or by powers of the eigenvalues of A_tilda ('eig', real part kept)
+    '''
+    if method == 'power':
+        states = np.empty((n_steps,len(a_tilda)),dtype=np.result_type(A_tilda,a_tilda))
+        for k in range(n_steps):
+            a_tilda = A_tilda @ a_tilda
+            states[k] = a_tilda
+        return states
+    if method == 'eig':
+        Lambda,W = np.linalg.eig(A_tilda)
+        b = np.linalg.solve(W,a_tilda)
+        powers = Lambda[None,:] ** np.arange(1,n_steps+1)[:,None]
+        return ((powers * b) @ W.T).real
+    raise ValueError('unknown forecast method {}, one of eig, power'.format(method))
+
+
+def forecast(Ur,A_tilda,a,n_steps,first_step=1,method='power'):
+    '''
+    Steps first_step .. n_steps of the DMD after the grid state a, shape (n_steps - first_step + 1, n_grid).
+    The state advances in the r reduced coordinates, only the returned steps are lifted back to the grid.
+    '''
+    states = reduced_forecast(A_tilda,Ur.T @ a,n_steps,method)
+    return states[first_step-1:] @ Ur.T
+
+
+def DMD_prediction(maps,n_pred_days=1,n_daily_samples = 12,svd='exact',rank=None,energy=None,method='power',**svd_kwargs):
+    '''
+    svd, rank and energy select the SVD backend and the number of modes (see truncated_svd),
+    the defaults keep every mode above SVD_THRESHOLD like the exact DMD.
+    method is how the reduced state is advanced (see reduced_forecast).
+    float32 maps give a float32 prediction. That only saves memory and time with the
+    randomized and snapshots backends: numpy's float32 LAPACK SVD of the exact backend
+    is no faster than float64 and its workspace peaks higher (about 149 vs 84 MB for
+    a 120 day window).
+    '''
     n_samples = n_pred_days * n_daily_samples
 
     d,s,h,w = maps.shape
@@ -29,21 +153,12 @@ def DMD_prediction(maps,n_pred_days=1,n_daily_samples = 12):
     X = A[:,:-1]
     Xprime = A[:,1:]
 
-    (Phi,Ur_prime,A_tilda,_) = DMD(X,Xprime)
-
-    pred_maps = []
-    a = A[:,-1]
+    Ur_prime,A_tilda = dmd_operator(X,Xprime,r=rank,svd=svd,energy=energy,**svd_kwargs)
 
-    for sample_idx in range(n_samples):
-        a_tilda = Ur_prime.T @ a
-        p = Ur_prime @ (A_tilda @ a_tilda)
-        
-        pred_maps.append(p)
-        a = p
+    # the first day of steps is not returned, nor lifted to the grid
+    pred_maps = forecast(Ur_prime,A_tilda,A[:,-1],n_samples,first_step=n_daily_samples+1,method=method)
 
-    pred_maps = np.array(pred_maps).reshape(n_samples,h,w)
-
-    return pred_maps[n_daily_samples:,:,:]
+    return pred_maps.reshape(-1,h,w)
 
 
 
@@ -51,7 +166,7 @@ def test():
     np.random.seed(1234)
     maps = np.random.random((30,12,5,4))*100
     preds = DMD_prediction(maps)
-   
+
     print(preds.shape)
 
 if __name__ == '__main__':
@@ -0,0 +1,133 @@
+import os
+import glob
+from collections import OrderedDict
+
+import numpy as np
+import cdflib
+
+CDF_VARIABLE = 'tecUQR'
+CACHE_DAYS = 8                      # decoded days kept in memory by a CDFCube
+
+
+def _info(info, field):
+    # cdflib < 1.0 returns dicts, later versions dataclasses
+    return info[field] if isinstance(info, dict) else getattr(info, field)
+
+
+def cdf_files(directory, years_list):
+    '''
+    Daily .cdf files of the years, in day order
+    '''
+    files = []
+    for year in years_list:
+        files += sorted(glob.glob(os.path.join(directory, str(year), '*.cdf')))
+    return files
+
+
+def _normalize(index, size):
+    '''
+    Indices of an int / slice / sequence index along an axis of that size, and whether the axis is kept
+    '''
+    if isinstance(index, slice):
+        return np.arange(size)[index], True
+    if np.ndim(index) == 0:
+        index = int(index)
+        if not -size <= index < size:
+            raise IndexError('index {} is out of bounds for axis with size {}'.format(index, size))
+        return np.array([index % size]), False
+    index = np.asarray(index)
+    if index.dtype == bool:
+        return np.flatnonzero(index), True
+    return np.asarray(index, np.intp) % size, True
+
+
+class CDFCube(object):
+    '''
+    Daily CDF files presented as one lazy (day, epoch, lat, lon) array.
+
+    Nothing is read when it is created but the first file's shape. Indexing reads only
+    the days asked for, and of every day only the epoch records between the first and the
+    last one selected; decoded days are kept in a small LRU so neighbouring slices reuse them.
+
+        cube = CDFCube(cdf_files('igs_15min', [2016, 2017]))
+        noon = cube[100:130, 44:52]         # (30, 8, lat, lon)
+        day = cube[365]
+        everything = np.asarray(cube)       # preallocated once, one file at a time
+    '''
+
+    def __init__(self, files, variable=CDF_VARIABLE, cache_days=CACHE_DAYS):
+        self.files = list(files)
+        self.variable = variable
+        self.cache_days = cache_days
+        self._cache = OrderedDict()
+        if len(self.files) == 0:
+            raise FileNotFoundError('no CDF files')
+        info = cdflib.CDF(self.files[0]).varinq(variable)
+        n_records = _info(info, 'Last_Rec') + 1
+        dims = tuple(int(d) for d in _info(info, 'Dim_Sizes'))
+        # epochs are the records of the variable, or its first dimension when it has one record
+        self.record_varying = n_records > 1 or len(dims) < 3
+        self.day_shape = (n_records,) + dims if self.record_varying else dims
+
+    @property
+    def shape(self):
+        return (len(self.files),) + self.day_shape
+
+    def __len__(self):
+        return len(self.files)
+
+    def _read(self, day, first, last):
+        '''
+        Epochs first .. last (inclusive) of a day
+        '''
+        if day in self._cache:
+            self._cache.move_to_end(day)
+            cached_first, values = self._cache[day]
+            if cached_first <= first and last < cached_first + len(values):
+                return values[first - cached_first:last - cached_first + 1]
+        cdf = cdflib.CDF(self.files[day])
+        if self.record_varying:
+            values = np.asarray(cdf.varget(self.variable, startrec=first, endrec=last))
+            values = values.reshape((last - first + 1,) + self.day_shape[1:])
+        else:
+            values = np.asarray(cdf.varget(self.variable))[first:last + 1]
+        if values.shape[1:] != self.day_shape[1:]:
+            raise ValueError('{} has maps of shape {} instead of {}'.format(self.files[day], values.shape[1:], self.day_shape[1:]))
+        self._cache[day] = (first, values)
+        while len(self._cache) > self.cache_days:
+            self._cache.popitem(last=False)
+        return values
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple): index = (index,)
+        if len(index) > 4:
+            raise IndexError('too many indices for a (day, epoch, lat, lon) array')
+        index = index + (slice(None),) * (4 - len(index))
+        days, keep_day = _normalize(index[0], len(self.files))
+        epochs, keep_epoch = _normalize(index[1], self.day_shape[0])
+        grid = index[2:]
+
+        out = None
+        for i, day in enumerate(days):
+            if len(epochs) == 0: break
+            first, last = int(epochs.min()), int(epochs.max())
+            values = self._read(day, first, last)[epochs - first]
+            values = values[(slice(None),) + grid]
+            if out is None:
+                out = np.empty((len(days),) + values.shape, values.dtype)
+            out[i] = values
+        if out is None:
+            out = np.empty((len(days), len(epochs)) + np.empty(self.day_shape[1:])[grid].shape)
+        if not keep_epoch: out = out[:, 0]
+        if not keep_day: out = out[0]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
+
+    def days(self, start, stop):
+        '''
+        Lazy cube of the days start .. stop - 1
+        '''
+        return CDFCube(self.files[start:stop], self.variable, self.cache_days)
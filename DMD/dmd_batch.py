@@ -0,0 +1,114 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count, shared_memory
+
+import numpy as np
+from tqdm import tqdm
+
+import DMD.algorithms_dmd as dmd
+from DMD.map_ingest import fill_from_previous, _shared_cube, _unlink
+from DMD.online_dmd import StreamingDMD, REFIT_DAYS
+
+DMD_WORKERS = max(1, cpu_count() // 2)    # every worker also runs a multithreaded BLAS
+
+
+def first_usable(ok, start, n_days):
+    '''
+    Offset of the first usable slot of the window start .. start + n_days, None when there is none
+    '''
+    window = ok[start:start + n_days]
+    return int(np.argmax(window)) if np.any(window) else None
+
+
+def window_maps(cube, ok, start, n_days):
+    '''
+    The get_numpy_rmsmaps window of the slots start .. start + n_days of a newest first cube:
+    failed slots repeat the newer one, the window starts at the first usable slot, oldest day first
+    '''
+    maps = cube[start:start + n_days].copy()
+    first = fill_from_previous(maps, ok[start:start + n_days])
+    return maps[first:][::-1]
+
+
+def chains(windows, streaming):
+    '''
+    Groups the (date_index, start, n_pred_days) windows into the units of work: runs of
+    consecutive days (windows one slot apart) when streaming, cut where the model would be
+    refitted anyway, every window alone otherwise
+    '''
+    if not streaming:
+        return [[window] for window in windows]
+    runs = []
+    for window in sorted(windows, key=lambda window: -window[1]):
+        if runs and runs[-1][-1][1] == window[1] + 1 and len(runs[-1]) <= REFIT_DAYS:
+            runs[-1].append(window)
+        else:
+            runs.append([window])
+    return runs
+
+
+def _predict_chain(cube, ok, chain, n_days, streaming, dmd_options):
+    '''
+    Predictions of the windows of a chain, a StreamingDMD slides from one day to the next when streaming
+    '''
+    options = dict(dmd_options)
+    method = options.pop('method', 'power')
+    predictions = []
+    model, previous = None, None
+    for date_index, start, n_pred_days in chain:
+        first = first_usable(ok, start, n_days)
+        if first is None:
+            predictions.append((date_index, None))
+            continue
+        if not streaming:
+            predictions.append((date_index, dmd.DMD_prediction(window_maps(cube, ok, start, n_days), n_pred_days=n_pred_days, **dmd_options)))
+            continue
+        # one day newer and as long as the previous window: the same days but the oldest and the newest
+        if model is not None and not model.needs_refit and previous == (start + 1, first):
+            model.update(cube[start + first])
+        else:
+            model = StreamingDMD.fit(window_maps(cube, ok, start, n_days), **options)
+        previous = (start, first)
+        predictions.append((date_index, model.predict(n_pred_days, method)))
+    return predictions
+
+
+def _chain_worker(shm_name, shape, dtype, ok, chain, n_days, streaming, dmd_options):
+    # workers share the parent's resource tracker, the segment stays registered once
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        cube = np.ndarray(shape, dtype, buffer=shm.buf)
+        predictions = _predict_chain(cube, ok, chain, n_days, streaming, dmd_options)
+        del cube
+    finally:
+        shm.close()
+    return predictions
+
+
+def predict_windows(cube, ok, windows, n_days, dmd_options=None, streaming=False, workers=DMD_WORKERS, desc=None):
+    '''
+    DMD predictions of many windows of one newest first (n_slots, n_maps, 71, 73) cube.
+
+    windows are (date_index, start, n_pred_days): the window of a date is the slots
+    start .. start + n_days. The cube is put in shared memory once and the chains of
+    windows (see chains) are spread over worker processes that read their windows from it.
+    Returns {date_index: predicted maps}, None for a window without any usable slot.
+    '''
+    dmd_options = dmd_options or {}
+    units = chains(windows, streaming)
+    predictions = {}
+
+    if workers <= 1 or len(units) <= 1:
+        for chain in tqdm(units, desc=desc, disable=desc is None):
+            predictions.update(_predict_chain(cube, ok, chain, n_days, streaming, dmd_options))
+        return predictions
+
+    shared, shm = _shared_cube(cube.shape, cube.dtype)
+    shared[...] = cube
+    # longest chains first, one chain per task keeps the workers busy until the end
+    units = sorted(units, key=len, reverse=True)
+    with ProcessPoolExecutor(min(workers, len(units))) as executor:
+        futures = [executor.submit(_chain_worker, shm.name, cube.shape, cube.dtype, ok, chain, n_days, streaming, dmd_options) for chain in units]
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc, disable=desc is None):
+            predictions.update(future.result())
+    _unlink(shm)
+    return predictions
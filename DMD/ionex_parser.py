@@ -0,0 +1,321 @@
+import mmap
+import datetime
+
+import numpy as np
+
+from utilities.network import read_decompressed, GZIP_MAGIC, LZW_MAGIC
+
+IONEX_LABEL_COLUMN = 60             # header style labels ('START OF TEC MAP', 'LAT/LON1/LON2/DLON/H', ...) start here
+IONEX_FIELD_WIDTH = 5               # I5 map values
+MAP_KINDS = ('TEC', 'RMS', 'HEIGHT')
+
+_NEWLINE, _CR, _SPACE, _MINUS = ord('\n'), ord('\r'), ord(' '), ord('-')
+_ZERO, _NINE, _A, _Z = ord('0'), ord('9'), ord('A'), ord('Z')
+
+
+class IonexMaps(object):
+    '''
+    Maps of one IONEX file, already scaled by their EXPONENT.
+
+    tec, rms : (n_maps, n_lat, n_lon) arrays, (0, n_lat, n_lon) when the file has none
+    epochs   : datetime of every TEC map (of every RMS map when there is no TEC)
+    lats, lons : grid of the maps, header : the header fields parse_ionex_header reads
+    '''
+
+    def __init__(self, tec, rms, epochs, lats, lons, header):
+        self.tec = tec
+        self.rms = rms
+        self.epochs = epochs
+        self.lats = lats
+        self.lons = lons
+        self.header = header
+
+
+def _epoch(content):
+    values = [int(float(v)) for v in content.split()[:6]]
+    return datetime.datetime(*values)
+
+
+def parse_ionex_header(header):
+    '''
+    EXPONENT, grid, map count and epoch fields of the header text (bytes or str)
+    '''
+    if isinstance(header, bytes): header = header.decode('ascii', errors='ignore')
+    fields = {'exponent': -1, 'lat': (87.5, -87.5, -2.5), 'lon': (-180.0, 180.0, 5.0),
+              'n_maps': None, 'interval': None, 'first_epoch': None, 'last_epoch': None}
+    for line in header.splitlines():
+        content, label = line[:IONEX_LABEL_COLUMN], line[IONEX_LABEL_COLUMN:].strip()
+        if label == 'EXPONENT':
+            fields['exponent'] = int(content.split()[0])
+        elif label == 'LAT1 / LAT2 / DLAT':
+            fields['lat'] = tuple(float(v) for v in content.split()[:3])
+        elif label == 'LON1 / LON2 / DLON':
+            fields['lon'] = tuple(float(v) for v in content.split()[:3])
+        elif label == '# OF MAPS IN FILE':
+            fields['n_maps'] = int(content.split()[0])
+        elif label == 'INTERVAL':
+            fields['interval'] = int(float(content.split()[0]))
+        elif label == 'EPOCH OF FIRST MAP':
+            fields['first_epoch'] = _epoch(content)
+        elif label == 'EPOCH OF LAST MAP':
+            fields['last_epoch'] = _epoch(content)
+    return fields
+
+
+def grid_axes(header):
+    lat1, lat2, dlat = header['lat']
+    lon1, lon2, dlon = header['lon']
+    n_lat = int(round((lat2 - lat1) / dlat)) + 1
+    n_lon = int(round((lon2 - lon1) / dlon)) + 1
+    return lat1 + dlat * np.arange(n_lat), lon1 + dlon * np.arange(n_lon)
+
+
+def _scan_lines(data):
+    '''
+    Line starts / ends of the byte array and which lines carry a label
+    '''
+    n = len(data)
+    newlines = np.flatnonzero(data == _NEWLINE)
+    starts = np.r_[0, newlines + 1]
+    ends = np.r_[newlines, n]
+    column = data[np.minimum(starts + IONEX_LABEL_COLUMN, max(n - 1, 0))]
+    is_label = (ends - starts > IONEX_LABEL_COLUMN) & (column >= _A) & (column <= _Z)
+    return starts, ends, is_label
+
+
+def _label_text(buffer, start, end):
+    return buffer[start + IONEX_LABEL_COLUMN:end].decode('ascii', errors='ignore').strip()
+
+
+def _parse_fixed_width(fields):
+    '''
+    Integer values of (n, 5) right aligned I5 fields, None when they are not I5 fields
+    '''
+    # one row per character position, the digit arithmetic runs on contiguous rows
+    columns = np.ascontiguousarray(fields.T)
+    last = columns[-1]
+    if not np.all((last >= _ZERO) & (last <= _NINE)):
+        return None
+    blank = columns == _SPACE
+    # right aligned: once a field starts it goes on to the last column
+    if np.any(blank[1:] & ~blank[:-1]):
+        return None
+    digits = np.maximum(columns.astype(np.int16) - _ZERO, 0).astype(np.int32)
+    values = digits[0]
+    for row in digits[1:]:
+        values = values * 10 + row
+    values[(columns == _MINUS).any(axis=0)] *= -1
+    return values
+
+
+def parse_ionex(buffer, kinds=('TEC', 'RMS'), dtype=np.float64):
+    '''
+    Single pass parser of the IONEX file content (bytes or mmap).
+
+    Label lines are located with one vectorized scan, the remaining bytes of the
+    requested maps are the I5 values and are decoded all at once into preallocated
+    (n_maps, n_lat, n_lon) arrays. Files whose maps are not I5 (e.g. written with
+    other widths or decimals) fall back to one whitespace split per map.
+    Returns an IonexMaps.
+    '''
+    data = np.frombuffer(buffer, np.uint8)
+    header_end = buffer.find(b'END OF HEADER')
+    if header_end < 0:
+        raise ValueError('IONEX without END OF HEADER')
+    header = parse_ionex_header(buffer[:header_end])
+    lats, lons = grid_axes(header)
+    map_size = len(lats) * len(lons)
+
+    starts, ends, is_label = _scan_lines(data)
+    first_line = np.searchsorted(starts, header_end, side='right')
+    label_lines = np.flatnonzero(is_label[first_line:]) + first_line
+
+    # the few structural labels are read one by one, the data lines never are
+    map_kinds, map_bounds, map_epochs, map_exponents = [], [], [], []
+    for line in label_lines:
+        start, end = starts[line], ends[line]
+        head = buffer[start + IONEX_LABEL_COLUMN:start + IONEX_LABEL_COLUMN + 2]
+        if head == b'ST':
+            map_kinds.append(_label_text(buffer, start, end).split()[2])
+            map_bounds.append([end, None])
+            map_epochs.append(None)
+            map_exponents.append(header['exponent'])
+        elif head == b'EN' and len(map_bounds) > 0 and map_bounds[-1][1] is None:
+            map_bounds[-1][1] = start
+        elif head == b'EP' and len(map_epochs) > 0:
+            map_epochs[-1] = _epoch(bytes(buffer[start:start + IONEX_LABEL_COLUMN]).decode('ascii'))
+        elif head == b'EX' and len(map_exponents) > 0:
+            map_exponents[-1] = int(bytes(buffer[start:start + IONEX_LABEL_COLUMN]).split()[0])
+
+    map_kinds = np.array(map_kinds)
+    result = {}
+    for kind in ('TEC', 'RMS'):
+        result[kind] = np.empty((0, len(lats), len(lons)), dtype)
+        if kind not in kinds: continue
+        indices = np.flatnonzero(map_kinds == kind)
+        if len(indices) == 0: continue
+        out = np.empty((len(indices), len(lats), len(lons)), dtype)
+        _parse_maps(data, starts, ends, is_label, [map_bounds[i] for i in indices], map_size, out)
+        scale = 10.0 ** np.array([map_exponents[i] for i in indices], np.float64)
+        out *= scale.astype(dtype)[:, None, None]
+        result[kind] = out
+
+    epoch_kind = 'TEC' if np.any(map_kinds == 'TEC') else 'RMS'
+    epochs = [epoch for epoch, kind in zip(map_epochs, map_kinds) if kind == epoch_kind]
+    return IonexMaps(result['TEC'], result['RMS'], epochs, lats, lons, header)
+
+
+def _parse_maps(data, starts, ends, is_label, bounds, map_size, out):
+    '''
+    Fills out (n_maps, n_lat, n_lon) with the raw values of the maps within bounds
+    '''
+    if any(end is None for _, end in bounds):
+        raise ValueError('IONEX map without END OF MAP')
+    first, last = bounds[0][0], bounds[-1][1]
+
+    # bytes of the requested maps that are neither label lines nor line breaks,
+    # maps of other kinds in between (e.g. HEIGHT maps) are left out as well
+    span = data[first:last]
+    line_range = slice(np.searchsorted(starts, first), np.searchsorted(starts, last))
+    inside = np.zeros(len(span) + 1, np.int8)
+    for start, end in bounds:
+        inside[start - first] += 1
+        inside[end - first] -= 1
+    inside[starts[line_range][is_label[line_range]] - first] -= 1
+    inside[ends[line_range][is_label[line_range]] - first] += 1
+    keep = (np.cumsum(inside[:-1], dtype=np.int8) > 0) & (span != _NEWLINE) & (span != _CR)
+
+    fields = span[keep]
+    if len(fields) == len(bounds) * map_size * IONEX_FIELD_WIDTH:
+        values = _parse_fixed_width(fields.reshape(-1, IONEX_FIELD_WIDTH))
+        if values is not None:
+            out.reshape(-1)[:] = values
+            return out
+
+    blanked = np.where(keep, span, _SPACE).astype(np.uint8).tobytes()
+    for i, (start, end) in enumerate(bounds):
+        values = np.array(blanked[start - first:end - first].split(), dtype=np.float64)
+        if values.size != map_size:
+            raise ValueError('IONEX map with {} values instead of {}'.format(values.size, map_size))
+        out[i] = values.reshape(out.shape[1:])
+    return out
+
+
+def read_ionex(file_path, kinds=('TEC', 'RMS'), dtype=np.float64):
+    # .Z / .gz products are decompressed in memory, nothing is extracted to disk
+    return parse_ionex(read_decompressed(file_path), kinds, dtype)
+
+
+def _is_compressed(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read(2) in (GZIP_MAGIC, LZW_MAGIC)
+
+
+class IonexFile(object):
+    '''
+    Epoch indexed random access to the maps of one IONEX file.
+
+    Opening memory maps the file and finds the byte offsets and epochs of every
+    START OF TEC/RMS MAP in one scan, maps are parsed only when asked for.
+    Compressed (.Z / .gz) files are decompressed in memory instead of mapped.
+
+        with IonexFile(file_path) as ionex:
+            tec = ionex.maps('TEC', epochs=[datetime.datetime(2022,1,1,12)])
+            value = ionex.get_tec(datetime.datetime(2022,1,1,12), lat=40.0, lon=-3.5)
+    '''
+
+    def __init__(self, file_path, dtype=np.float64):
+        self.file_path = file_path
+        self.dtype = dtype
+        if _is_compressed(file_path):
+            self.buffer = read_decompressed(file_path)
+        else:
+            with open(file_path, 'rb') as f:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_end = self.buffer.find(b'END OF HEADER')
+        if header_end < 0:
+            self.close()
+            raise ValueError('IONEX without END OF HEADER')
+        self.header = parse_ionex_header(self.buffer[:header_end])
+        self.lats, self.lons = grid_axes(self.header)
+        self.offsets = {}           # kind: [(first byte, last byte) of every map]
+        self.epochs = {}            # kind: [epoch of every map]
+        self._scan(header_end)
+
+    def _scan(self, position):
+        buffer = self.buffer
+        while True:
+            start = buffer.find(b'START OF ', position)
+            if start < 0: break
+            line_end = buffer.find(b'\n', start)
+            kind = bytes(buffer[start:line_end]).split()[2].decode()
+            end = buffer.find('END OF {} MAP'.format(kind).encode(), line_end)
+            if end < 0:
+                raise ValueError('IONEX map without END OF MAP')
+            end = buffer.rfind(b'\n', line_end, end) + 1
+            # EPOCH OF CURRENT MAP is the first record of a map
+            epoch = _epoch(bytes(buffer[line_end + 1:line_end + 1 + IONEX_LABEL_COLUMN]).decode('ascii'))
+            self.offsets.setdefault(kind, []).append((line_end, end))
+            self.epochs.setdefault(kind, []).append(epoch)
+            position = end
+
+    def n_maps(self, kind='TEC'):
+        return len(self.offsets.get(kind, []))
+
+    def index(self, epoch, kind='TEC'):
+        '''
+        Index of the map of that epoch, of the closest one when no map matches exactly
+        '''
+        epochs = self.epochs.get(kind, [])
+        if len(epochs) == 0:
+            raise KeyError('no {} maps in {}'.format(kind, self.file_path))
+        return min(range(len(epochs)), key=lambda i: abs((epochs[i] - epoch).total_seconds()))
+
+    def maps(self, kind='TEC', epochs=None, indices=None):
+        '''
+        (n, n_lat, n_lon) maps of the requested epochs or indices (every map when neither is given)
+        '''
+        if indices is None:
+            indices = range(self.n_maps(kind)) if epochs is None else [self.index(epoch, kind) for epoch in epochs]
+        out = np.empty((len(indices), len(self.lats), len(self.lons)), self.dtype)
+        for i, index in enumerate(indices):
+            self._parse_map(kind, index, out[i])
+        return out
+
+    def map(self, kind='TEC', epoch=None, index=None):
+        if index is None: index = self.index(epoch, kind)
+        return self.maps(kind, indices=[index])[0]
+
+    def _parse_map(self, kind, index, out):
+        first, last = self.offsets[kind][index]
+        chunk = self.buffer[first:last]
+        data = np.frombuffer(chunk, np.uint8)
+        starts, ends, is_label = _scan_lines(data)
+        _parse_maps(data, starts, ends, is_label, [(0, len(data))], out.size, out[None])
+
+        exponent = self.header['exponent']
+        position = chunk.find(b'EXPONENT')
+        if position >= 0:
+            line_start = chunk.rfind(b'\n', 0, position) + 1
+            exponent = int(chunk[line_start:line_start + IONEX_LABEL_COLUMN].split()[0])
+        out *= 10.0 ** exponent
+        return out
+
+    def get_tec(self, epoch, lat, lon, kind='TEC'):
+        '''
+        Value of the grid point closest to (lat, lon) in the map closest to epoch
+        '''
+        i = int(np.argmin(np.abs(self.lats - lat)))
+        j = int(np.argmin(np.abs(self.lons - lon)))
+        return self.map(kind, epoch)[i, j]
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,94 @@
+import os
+import glob
+import hashlib
+
+import numpy as np
+from atomicwrites import atomic_write
+
+from DMD.ionex_parser import read_ionex
+
+MAP_CACHE_DIR = os.path.join('TEMP','map_cache')
+MAP_CACHE_MAX_BYTES = 1024 ** 3     # least recently used sidecars are evicted above this
+MAP_CACHE_EVICT_TO = 0.8            # fraction of the budget an eviction frees down to, the next ones are far apart
+USE_MAP_CACHE = True
+
+_cache_bytes = None                 # size of the cache as this process knows it, None until evict() scanned it
+
+
+def _cache_key(file_path, kind):
+    return hashlib.sha1('{}|{}'.format(os.path.abspath(file_path), kind).encode()).hexdigest()
+
+
+def _cache_path(file_path, kind, stat):
+    # size and mtime are part of the name, a changed source simply misses
+    return os.path.join(MAP_CACHE_DIR, '{}_{}_{}.npy'.format(_cache_key(file_path, kind), stat.st_size, stat.st_mtime_ns))
+
+
+def evict(max_bytes=MAP_CACHE_MAX_BYTES):
+    '''
+    Removes the least recently used sidecars until the cache holds at most max_bytes.
+    Scans the whole cache: cached_ionex_maps calls it on its first write and then only
+    when the running total of what it wrote goes over budget.
+    '''
+    global _cache_bytes
+    try:
+        with os.scandir(MAP_CACHE_DIR) as entries:
+            files = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries if entry.name.endswith('.npy')]
+    except OSError:
+        return
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes: break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+    _cache_bytes = total
+
+
+def _grow(n_bytes, max_bytes=MAP_CACHE_MAX_BYTES):
+    # sidecars written by other processes are only counted at the next scan
+    global _cache_bytes
+    if _cache_bytes is not None:
+        _cache_bytes += n_bytes
+        if _cache_bytes <= max_bytes: return
+    evict(int(max_bytes * MAP_CACHE_EVICT_TO))
+
+
+def cached_ionex_maps(file_path, kind='RMS'):
+    '''
+    (n_maps, 71, 73) TEC or RMS maps of an IONEX file.
+
+    Parsed maps are kept as .npy sidecars in TEMP/map_cache keyed by the file path,
+    size and mtime, so unchanged products are loaded instead of parsed again.
+    '''
+    if not USE_MAP_CACHE:
+        return getattr(read_ionex(file_path, kinds=(kind,)), kind.lower())
+
+    stat = os.stat(file_path)
+    cache_path = _cache_path(file_path, kind, stat)
+    try:
+        maps = np.load(cache_path)
+        # the sidecar mtime is its last use, evict() goes by it
+        os.utime(cache_path)
+        return maps
+    except (OSError, ValueError):
+        pass
+
+    maps = getattr(read_ionex(file_path, kinds=(kind,)), kind.lower())
+
+    os.makedirs(MAP_CACHE_DIR, exist_ok=True)
+    # sidecars of older versions of the file
+    removed = 0
+    for stale_path in glob.glob(os.path.join(MAP_CACHE_DIR, '{}_*.npy'.format(_cache_key(file_path, kind)))):
+        try:
+            size = os.path.getsize(stale_path)
+            os.remove(stale_path)
+            removed += size
+        except OSError:
+            pass
+    with atomic_write(cache_path, mode='wb', overwrite=True) as f:
+        np.save(f, maps)
+    _grow(os.path.getsize(cache_path) - removed)
+    return maps
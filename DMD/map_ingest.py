@@ -0,0 +1,111 @@
+import weakref
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count, shared_memory
+
+import numpy as np
+from tqdm import tqdm
+
+from DMD.map_cache import cached_ionex_maps
+
+INGEST_WORKERS = max(1, cpu_count() // 2)
+PARALLEL_MIN_FILES = 16             # below this the process start-up costs more than it saves
+DAILY_MAPS = 13                     # 2h maps of a day, 1h products keep every other map
+MAP_SHAPE = (71, 73)
+
+
+def _load_into(out, file_path, kind, max_value):
+    '''
+    Writes the daily maps of file_path into out, False when the file is missing or unusable
+    '''
+    try:
+        maps = cached_ionex_maps(file_path, kind)
+    except Exception:
+        return False
+    if maps.size == 0 or (max_value is not None and np.max(maps) > max_value):
+        return False
+    if maps.shape[0] > out.shape[0]:
+        maps = maps[0:2 * out.shape[0]:2]
+    if maps.shape != out.shape:
+        return False
+    out[...] = maps
+    return True
+
+
+def _ingest_worker(shm_name, shape, dtype, jobs, kind, max_value):
+    # workers share the parent's resource tracker, the segment stays registered once
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        cube = np.ndarray(shape, dtype, buffer=shm.buf)
+        loaded = [(i, _load_into(cube[i], file_path, kind, max_value)) for i, file_path in jobs]
+        del cube
+    finally:
+        shm.close()
+    return loaded
+
+
+def _shared_cube(shape, dtype):
+    '''
+    Zeroed array in a shared memory segment that lives as long as the array
+    '''
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    cube = np.ndarray(shape, dtype, buffer=shm.buf)
+    cube[...] = 0
+    weakref.finalize(cube, _release, shm)
+    return cube, shm
+
+
+def _unlink(shm):
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _release(shm):
+    shm.close()
+    _unlink(shm)
+
+
+def ingest_maps(file_paths, kind='RMS', n_maps=DAILY_MAPS, max_value=None, workers=INGEST_WORKERS, desc=None, dtype=np.float64):
+    '''
+    Loads the daily maps of many IONEX files into one (n_files, n_maps, 71, 73) cube.
+
+    The cube is allocated once, in shared memory when the files are spread over worker
+    processes, and every worker writes its files straight into their slots.
+    Returns (cube, ok), ok[i] is False where file_paths[i] was missing, unreadable or had
+    a value above max_value; those slots are left zero for the caller to fill.
+    dtype is that of the cube (float32 halves it), files are parsed and checked in float64.
+    '''
+    shape = (len(file_paths), n_maps) + MAP_SHAPE
+    ok = np.zeros(len(file_paths), bool)
+
+    if workers <= 1 or len(file_paths) < PARALLEL_MIN_FILES:
+        cube = np.zeros(shape, dtype)
+        for i, file_path in enumerate(tqdm(file_paths, desc=desc, disable=desc is None)):
+            ok[i] = _load_into(cube[i], file_path, kind, max_value)
+        return cube, ok
+
+    cube, shm = _shared_cube(shape, dtype)
+    jobs = list(enumerate(file_paths))
+    chunks = [jobs[i::workers] for i in range(workers) if len(jobs[i::workers]) > 0]
+    with ProcessPoolExecutor(len(chunks)) as executor:
+        futures = [executor.submit(_ingest_worker, shm.name, shape, dtype, chunk, kind, max_value) for chunk in chunks]
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc, disable=desc is None):
+            for i, loaded in future.result():
+                ok[i] = loaded
+    # no more attachments, the segment itself goes away with the cube
+    _unlink(shm)
+    return cube, ok
+
+
+def fill_from_previous(cube, ok):
+    '''
+    Replaces every failed slot by the closest earlier usable one, in place.
+    Returns the index of the first usable slot (slots before it have nothing to reuse).
+    '''
+    first = np.argmax(ok) if np.any(ok) else len(ok)
+    for i in range(first + 1, len(ok)):
+        if not ok[i]:
+            cube[i] = cube[i - 1]
+    return first
@@ -0,0 +1,118 @@
+import numpy as np
+
+from DMD.ionex_parser import grid_axes, parse_ionex_header
+
+DAY_SECONDS = 86400
+DEFAULT_LATS, DEFAULT_LONS = grid_axes(parse_ionex_header(''))     # 87.5 .. -87.5, -180 .. 180
+
+
+def _seconds(times, origin):
+    '''
+    Seconds since origin of datetimes / datetime64 values, numbers are taken as seconds already
+    '''
+    times = np.asarray(times)
+    if origin is None or np.issubdtype(times.dtype, np.number):
+        return times.astype(np.float64)
+    times = times.astype('datetime64[us]')
+    return (times - np.datetime64(origin, 'us')).astype(np.float64) / 1e6
+
+
+def daily_epochs(first_day, n_days, n_maps=13):
+    '''
+    Epochs of an (n_days, n_maps, ...) cube of daily files, n_maps - 1 intervals per day
+    (13 maps for 2h products, 25 for 1h ones)
+    '''
+    interval = DAY_SECONDS // (n_maps - 1)
+    day = np.datetime64(first_day, 'D').astype('datetime64[s]')
+    return (day + np.arange(n_days)[:, None] * np.timedelta64(DAY_SECONDS, 's')
+            + np.arange(n_maps)[None, :] * np.timedelta64(interval, 's'))
+
+
+def stack_daily(cube, first_day):
+    '''
+    (n_epochs, n_lat, n_lon) maps and their epochs out of an (n_days, n_maps, n_lat, n_lon) cube
+    of consecutive days, the midnight map every file repeats from the next one is kept once
+    '''
+    n_days, n_maps = cube.shape[:2]
+    epochs = daily_epochs(first_day, n_days, n_maps)
+    keep = np.ones((n_days, n_maps), bool)
+    keep[:-1, -1] = False
+    return cube[keep], epochs[keep]
+
+
+def _lon_period(lons):
+    dlon = lons[1] - lons[0]
+    period = int(round(360.0 / abs(dlon)))
+    # global grids wrap around, the last column of -180 .. 180 grids repeats the first one
+    return period if len(lons) >= period else None
+
+
+def _bilinear(maps, k, lat_pos, lon_pos, period):
+    n_lat, n_lon = maps.shape[1:]
+    i0 = np.clip(np.floor(lat_pos).astype(np.intp), 0, max(n_lat - 2, 0))
+    fi = np.clip(lat_pos - i0, 0.0, 1.0)
+    i1 = np.minimum(i0 + 1, n_lat - 1)
+
+    if period is None:
+        j0 = np.clip(np.floor(lon_pos).astype(np.intp), 0, max(n_lon - 2, 0))
+        fj = np.clip(lon_pos - j0, 0.0, 1.0)
+        j1 = np.minimum(j0 + 1, n_lon - 1)
+    else:
+        lon_pos = np.mod(lon_pos, period)
+        j0 = np.floor(lon_pos).astype(np.intp)
+        fj = lon_pos - j0
+        j0 %= period
+        j1 = (j0 + 1) % period
+
+    return ((1 - fi) * ((1 - fj) * maps[k, i0, j0] + fj * maps[k, i0, j1])
+            + fi * ((1 - fj) * maps[k, i1, j0] + fj * maps[k, i1, j1]))
+
+
+def sample_maps(maps, epochs, times, lats, lons, grid_lats=DEFAULT_LATS, grid_lons=DEFAULT_LONS, rotate=False):
+    '''
+    TEC / RMS values at arbitrary (time, lat, lon) points, in one vectorized pass.
+
+    maps is (n_epochs, n_lat, n_lon) with its epochs (datetimes or datetime64, any map
+    interval), times / lats / lons are broadcast together and the result has their shape.
+    Values are bilinear in lat / lon and linear in time between the two maps around
+    every point; longitudes wrap on global grids and points outside the map epochs are NaN.
+    rotate applies the sun-fixed rotation of the IONEX standard: each of the two maps is
+    read at the longitude the point had at that map's epoch.
+    '''
+    maps = np.asarray(maps)
+    if maps.ndim == 2: maps = maps[None]
+    epochs = np.asarray(epochs)
+    origin = None if np.issubdtype(epochs.dtype, np.number) else epochs.ravel()[0]
+    epoch_s = _seconds(epochs, origin).ravel()
+    times, lats, lons = np.broadcast_arrays(_seconds(times, origin), np.asarray(lats, np.float64),
+                                            np.asarray(lons, np.float64))
+
+    grid_lats = np.asarray(grid_lats, np.float64)
+    grid_lons = np.asarray(grid_lons, np.float64)
+    lat_pos = (lats - grid_lats[0]) / (grid_lats[1] - grid_lats[0])
+    dlon = grid_lons[1] - grid_lons[0]
+    period = _lon_period(grid_lons)
+
+    n = len(epoch_s)
+    k0 = np.clip(np.searchsorted(epoch_s, times, side='right') - 1, 0, max(n - 2, 0))
+    k1 = np.minimum(k0 + 1, n - 1)
+    span = epoch_s[k1] - epoch_s[k0]
+    ft = np.divide(times - epoch_s[k0], span, out=np.zeros(times.shape), where=span > 0)
+
+    shift0 = shift1 = 0.0
+    if rotate:
+        shift0 = (times - epoch_s[k0]) * 360.0 / DAY_SECONDS
+        shift1 = (times - epoch_s[k1]) * 360.0 / DAY_SECONDS
+    v0 = _bilinear(maps, k0, lat_pos, (lons + shift0 - grid_lons[0]) / dlon, period)
+    v1 = _bilinear(maps, k1, lat_pos, (lons + shift1 - grid_lons[0]) / dlon, period)
+
+    values = (1 - ft) * v0 + ft * v1
+    return np.where((times < epoch_s[0]) | (times > epoch_s[-1]), np.nan, values)
+
+
+def sample_ionex(ionex_maps, times, lats, lons, kind='TEC', rotate=False):
+    '''
+    sample_maps on the TEC or RMS maps of a parsed file (ionex_parser.IonexMaps)
+    '''
+    return sample_maps(getattr(ionex_maps, kind.lower()), ionex_maps.epochs, times, lats, lons,
+                       ionex_maps.lats, ionex_maps.lons, rotate)
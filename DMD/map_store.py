@@ -0,0 +1,309 @@
+import os
+import json
+import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+from DMD.ionex_parser import read_ionex
+from DMD.map_ingest import INGEST_WORKERS, PARALLEL_MIN_FILES, DAILY_MAPS, MAP_SHAPE
+from utilities.product_index import classify_product_name
+
+MAP_STORE_NAME = 'maps.h5'
+MAP_KINDS = ('TEC', 'RMS')
+MAP_SCALE = 0.1                     # values are kept as int16 counts of the usual IONEX EXPONENT -1
+FILL = np.iinfo(np.int16).min       # (agency, day) slots without a product
+CHUNK_DAYS = 16                     # days per chunk, a 120 day window reads 8-9 chunks
+SOURCE_NAME_SIZE = 64
+CHUNK_CACHE_BYTES = 64 * 1024 ** 2  # per dataset, keeps the chunks being filled uncompressed until they are done
+
+# long names: final before rapid, 2h before 1h (IONEXv2 priority order), old names after them
+_SOLUTION_RANK = {'FIN': 0, 'RAP': 1}
+_RESOLUTION_RANK = {'02H': 0, '01H': 1}
+
+
+def _name_priority(file_name):
+    parts = file_name.split('_')
+    if len(parts) < 5:
+        return (2, 0, 0)
+    return (0, _RESOLUTION_RANK.get(parts[3], 2), _SOLUTION_RANK.get(parts[0][-3:], 2))
+
+
+def _daily_counts(file_path):
+    '''
+    (TEC, RMS) int16 counts of the 13 daily maps, None for kinds the file does not have
+    '''
+    maps = read_ionex(file_path)
+    result = []
+    for kind in MAP_KINDS:
+        values = getattr(maps, kind.lower())
+        if values.shape[0] > DAILY_MAPS:
+            values = values[0:2 * DAILY_MAPS:2]
+        if values.shape != (DAILY_MAPS,) + MAP_SHAPE:
+            result.append(None)
+            continue
+        result.append(np.clip(np.rint(values / MAP_SCALE), FILL + 1, np.iinfo(np.int16).max).astype(np.int16))
+    return tuple(result)
+
+
+def _daily_counts_or_none(file_path):
+    try:
+        return _daily_counts(file_path)
+    except Exception:
+        return None
+
+
+class MapStore(object):
+    '''
+    Every IONEX product of a folder in one chunked, compressed HDF5 file.
+
+    TEC and RMS are (agency, day, epoch, lat, lon) int16 datasets, gzip compressed in
+    chunks of CHUNK_DAYS days of one agency, with the 13 two-hourly maps of each day
+    (1h products keep every other map, like the rest of the pipeline). The day axis
+    starts at the 'first_day' attribute and grows at either end, new agencies add a row.
+    Every (agency, day) slot remembers the file name and mtime it was filled from, so
+    adding a folder again only parses new, updated or higher priority products.
+
+        store = MapStore('ION/maps.h5')
+        store.add_directory('ION')
+        rms, present = store.window('igs', datetime.datetime(2022,1,1), 120, 'RMS')
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def _open(self, mode='r'):
+        if mode != 'r': os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        return h5py.File(self.path, mode, rdcc_nbytes=CHUNK_CACHE_BYTES, rdcc_nslots=1009)
+
+    def _create(self, f):
+        f.attrs['agencies'] = json.dumps([])
+        f.attrs['first_day'] = -1
+        f.attrs['scale'] = MAP_SCALE
+        for kind in MAP_KINDS:
+            f.create_dataset(kind, shape=(0, 0, DAILY_MAPS) + MAP_SHAPE, maxshape=(None, None, DAILY_MAPS) + MAP_SHAPE,
+                             dtype=np.int16, chunks=(1, CHUNK_DAYS, DAILY_MAPS) + MAP_SHAPE,
+                             compression='gzip', compression_opts=4, shuffle=True, fillvalue=FILL)
+        f.create_dataset('source', shape=(0, 0), maxshape=(None, None), dtype='S{}'.format(SOURCE_NAME_SIZE),
+                         chunks=(1, 1024))
+        f.create_dataset('source_mtime', shape=(0, 0), maxshape=(None, None), dtype=np.int64,
+                         chunks=(1, 1024), fillvalue=-1)
+
+    def agencies(self):
+        if not os.path.isfile(self.path): return []
+        with self._open() as f:
+            return json.loads(f.attrs['agencies'])
+
+    def days(self):
+        '''
+        Dates covered by the day axis
+        '''
+        if not os.path.isfile(self.path): return []
+        with self._open() as f:
+            first_day, n_days = int(f.attrs['first_day']), f['source'].shape[1]
+        return [datetime.datetime.fromordinal(first_day + i) for i in range(n_days)]
+
+    def _datasets(self, f):
+        return [f[kind] for kind in MAP_KINDS] + [f['source'], f['source_mtime']]
+
+    def _ensure_slots(self, f, keys):
+        '''
+        Grows the agency and day axes once for all the (agency, day) keys, returns (agencies, first_day)
+        '''
+        agencies = json.loads(f.attrs['agencies'])
+        new_agencies = sorted(set(agency for agency, _ in keys) - set(agencies))
+        if len(new_agencies) > 0:
+            agencies += new_agencies
+            f.attrs['agencies'] = json.dumps(agencies)
+            for dataset in self._datasets(f):
+                dataset.resize(len(agencies), axis=0)
+
+        first_day, n_days = int(f.attrs['first_day']), f['source'].shape[1]
+        min_day, max_day = min(day for _, day in keys), max(day for _, day in keys)
+        if n_days == 0:
+            f.attrs['first_day'] = first_day = min_day
+        if min_day < first_day:
+            # rare (older products added later): every day moves right, block by block from the end
+            shift = first_day - min_day
+            for dataset in self._datasets(f):
+                dataset.resize(n_days + shift, axis=1)
+                for stop in range(n_days, 0, -CHUNK_DAYS):
+                    start = max(0, stop - CHUNK_DAYS)
+                    dataset[:, start + shift:stop + shift] = dataset[:, start:stop]
+                dataset[:, 0:shift] = np.full(dataset[:, 0:shift].shape, dataset.fillvalue, dataset.dtype)
+            f.attrs['first_day'] = first_day = min_day
+            n_days += shift
+        if max_day - first_day >= n_days:
+            for dataset in self._datasets(f):
+                dataset.resize(max_day - first_day + 1, axis=1)
+        return agencies, first_day
+
+    def _write_chunk(self, f, chunk, columns):
+        '''
+        Writes {column: (TEC, RMS) counts} of one (agency row, chunk of days) at once
+        '''
+        if len(columns) == 0: return
+        row, index = chunk
+        start = index * CHUNK_DAYS
+        stop = min(start + CHUNK_DAYS, f['source'].shape[1])
+        for k, kind in enumerate(MAP_KINDS):
+            block = f[kind][row, start:stop]
+            for column, counts in columns.items():
+                block[column - start] = counts[k] if counts[k] is not None else FILL
+            f[kind][row, start:stop] = block
+
+    def _slot(self, f, agency, day):
+        agencies = json.loads(f.attrs['agencies'])
+        if agency not in agencies: return None
+        column = day - int(f.attrs['first_day'])
+        if not 0 <= column < f['source'].shape[1]: return None
+        return agencies.index(agency), column
+
+    def _pending(self, f, file_paths):
+        '''
+        Files whose product is not in the store yet, or is there from an older or lower priority file
+        '''
+        # the slot bookkeeping is small, read once instead of per file
+        sources, mtimes = f['source'][...], f['source_mtime'][...]
+        pending = {}
+        for file_path in file_paths:
+            if file_path is None or not os.path.isfile(file_path): continue
+            name = os.path.basename(file_path)
+            product = classify_product_name(name)
+            if product is None or product[0] != 'ionex': continue
+            _, agency, date = product
+            key = (agency, date.toordinal())
+            if key in pending and _name_priority(os.path.basename(pending[key])) <= _name_priority(name): continue
+            slot = self._slot(f, *key)
+            if slot is not None:
+                source = sources[slot].decode()
+                if source == name and mtimes[slot] == os.stat(file_path).st_mtime_ns: continue
+                if source and source != name and _name_priority(source) < _name_priority(name): continue
+            pending[key] = file_path
+        return pending
+
+    def add_files(self, file_paths, workers=INGEST_WORKERS, desc=None):
+        '''
+        Adds the IONEX files that are new to the store, returns how many were written
+        '''
+        exists = os.path.isfile(self.path)
+        with self._open('a' if exists else 'w') as f:
+            if not exists: self._create(f)
+            pending = self._pending(f, file_paths)
+            if len(pending) == 0: return 0
+            # agency and day order, the products of one chunk arrive one after the other
+            keys, paths = zip(*sorted(pending.items()))
+            agencies, first_day = self._ensure_slots(f, keys)
+            sources, mtimes = f['source'][...], f['source_mtime'][...]
+
+            if workers <= 1 or len(paths) < PARALLEL_MIN_FILES:
+                results = map(_daily_counts_or_none, paths)
+                executor = None
+            else:
+                executor = ProcessPoolExecutor(workers)
+                results = executor.map(_daily_counts_or_none, paths, chunksize=4)
+            written = 0
+            chunk, columns = None, {}
+            try:
+                for (agency, day), file_path, counts in tqdm(zip(keys, paths, results), total=len(paths), desc=desc, disable=desc is None):
+                    if counts is None or all(c is None for c in counts): continue
+                    row, column = agencies.index(agency), day - first_day
+                    if (row, column // CHUNK_DAYS) != chunk:
+                        self._write_chunk(f, chunk, columns)
+                        chunk, columns = (row, column // CHUNK_DAYS), {}
+                    columns[column] = counts
+                    sources[row, column] = os.path.basename(file_path).encode()[:SOURCE_NAME_SIZE]
+                    mtimes[row, column] = os.stat(file_path).st_mtime_ns
+                    written += 1
+                self._write_chunk(f, chunk, columns)
+            finally:
+                if executor is not None: executor.shutdown()
+            f['source'][...] = sources
+            f['source_mtime'][...] = mtimes
+        return written
+
+    def add_directory(self, directory, workers=INGEST_WORKERS, desc='Map store'):
+        with os.scandir(directory) as entries:
+            file_paths = sorted(entry.path for entry in entries if entry.is_file())
+        return self.add_files(file_paths, workers, desc)
+
+    def _values(self, counts, dtype=np.float64):
+        values = counts.astype(dtype) * MAP_SCALE
+        present = counts[..., 0, 0, 0] != FILL
+        return values, present
+
+    def window(self, agency, first_date, n_days, kind='RMS', dtype=np.float64):
+        '''
+        (n_days, 13, 71, 73) maps of one agency from first_date on, read as one slice,
+        and which of the days have a product (the others are zero)
+        '''
+        out = np.full((n_days, DAILY_MAPS) + MAP_SHAPE, FILL, np.int16)
+        if os.path.isfile(self.path):
+            with self._open() as f:
+                agencies = json.loads(f.attrs['agencies'])
+                if agency in agencies:
+                    start = first_date.toordinal() - int(f.attrs['first_day'])
+                    stop = min(start + n_days, f[kind].shape[1])
+                    if stop > max(start, 0):
+                        out[max(start, 0) - start:stop - start] = f[kind][agencies.index(agency), max(start, 0):stop]
+        values, present = self._values(out, dtype)
+        values[~present] = 0
+        return values, present
+
+    def maps(self, file_paths, kind='RMS', max_value=None, dtype=np.float64):
+        '''
+        Same contract as map_ingest.ingest_maps: (cube, ok) of the daily maps of file_paths.
+
+        Products not in the store yet are added first; the maps of every agency are then
+        read as one slice over the days asked for instead of parsing each file. A slot
+        holds the highest priority product of its agency and day, which is what a file
+        of lower priority gets.
+        '''
+        self.add_files(file_paths)
+        cube = np.zeros((len(file_paths), DAILY_MAPS) + MAP_SHAPE, dtype)
+        ok = np.zeros(len(file_paths), bool)
+        if not os.path.isfile(self.path): return cube, ok
+
+        slots = {}
+        for i, file_path in enumerate(file_paths):
+            product = classify_product_name(os.path.basename(file_path)) if file_path is not None else None
+            if product is None or product[0] != 'ionex' or not os.path.isfile(file_path): continue
+            slots.setdefault(product[1], []).append((i, product[2].toordinal()))
+
+        with self._open() as f:
+            agencies = json.loads(f.attrs['agencies'])
+            first_day, n_days = int(f.attrs['first_day']), f[kind].shape[1]
+            for agency, items in slots.items():
+                if agency not in agencies: continue
+                indices = np.array([i for i, _ in items])
+                columns = np.array([day for _, day in items]) - first_day
+                inside = (columns >= 0) & (columns < n_days)
+                if not np.any(inside): continue
+                indices, columns = indices[inside], columns[inside]
+                block = f[kind][agencies.index(agency), columns.min():columns.max() + 1]
+                values, present = self._values(block[columns - columns.min()], dtype)
+                cube[indices] = values
+                ok[indices] = present
+        if max_value is not None:
+            ok &= ~np.any(cube > max_value, axis=(1, 2, 3))
+        cube[~ok] = 0
+        return cube, ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Adds the IONEX products of a folder to a map store')
+    parser.add_argument('directory', help='product folder, e.g. ION')
+    parser.add_argument('--store', default=None, help='HDF5 file, <directory>/{} by default'.format(MAP_STORE_NAME))
+    parser.add_argument('--workers', type=int, default=INGEST_WORKERS)
+    args = parser.parse_args(argv)
+
+    store = MapStore(args.store or os.path.join(args.directory, MAP_STORE_NAME))
+    written = store.add_directory(args.directory, args.workers)
+    print('{} products added to {} ({} agencies, {} days)'.format(written, store.path, len(store.agencies()), len(store.days())))
+
+
+if __name__ == '__main__':
+    main()
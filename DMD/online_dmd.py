@@ -0,0 +1,125 @@
+import os
+
+import numpy as np
+from atomicwrites import atomic_write
+
+from DMD.algorithms_dmd import truncated_svd, select_rank, reduced_forecast, SVD_THRESHOLD
+
+STREAMING_RANK = 200                # modes kept between updates
+REFIT_DAYS = 30                     # updates before the basis is recomputed from the window itself
+DMD_STATE_NAME = 'dmd_state.npz'
+
+
+class StreamingDMD(object):
+    '''
+    Sliding-window DMD that absorbs one day of maps at a time.
+
+    The window is kept as a rank r POD basis U (n_grid, r) and the reduced coordinates
+    B (r, n_snapshots) of its snapshots. update() projects the new day on U, extends the
+    basis with the orthonormalized residual, drops the oldest day's columns and truncates
+    again with the SVD of the small (r + k, n_snapshots) core: the cost per day grows with
+    n_grid * r^2 instead of the SVD of the whole (n_grid, n_snapshots) window.
+    Truncation errors add up, every REFIT_DAYS updates the caller is told to refit
+    (needs_refit) from the full window with fit().
+
+        model = StreamingDMD.fit(rms_maps, rank=200, keys=product_names)
+        model.update(newest_day_maps, key=newest_product_name)
+        pred_maps = model.predict(n_pred_days=2)
+        model.save('dmd_state.npz')
+    '''
+
+    def __init__(self, U, B, norms2, shape, n_daily_samples=12, rank=STREAMING_RANK, energy=None,
+                 keys=None, updates=0):
+        self.U = U
+        self.B = B
+        self.norms2 = norms2        # squared norm of every snapshot, the energy of the window
+        self.shape = tuple(shape)   # (maps per day, n_lat, n_lon)
+        self.n_daily_samples = n_daily_samples
+        self.rank = rank
+        self.energy = energy
+        self.keys = list(keys) if keys is not None else []
+        self.updates = updates
+
+    @classmethod
+    def fit(cls, maps, rank=STREAMING_RANK, energy=None, n_daily_samples=12, keys=None, svd='randomized', **svd_kwargs):
+        '''
+        Model of a (days, maps per day, n_lat, n_lon) window, keys name its days (e.g. product files)
+        '''
+        d, s, h, w = maps.shape
+        A = maps.reshape(d * s, h * w).T
+        U, S, Vt = truncated_svd(A, svd, rank=rank, energy=energy, **svd_kwargs)
+        return cls(U, S[:, None] * Vt, np.sum(A ** 2, axis=0, dtype=np.float64), (s, h, w), n_daily_samples, rank, energy,
+                   keys if keys is not None else [None] * d)
+
+    @property
+    def n_days(self):
+        return self.B.shape[1] // self.shape[0]
+
+    @property
+    def needs_refit(self):
+        return self.updates >= REFIT_DAYS
+
+    def update(self, day_maps, key=None):
+        '''
+        Appends one day of maps (maps per day, n_lat, n_lon) and drops the oldest day
+        '''
+        s = self.shape[0]
+        C = np.asarray(day_maps, self.U.dtype).reshape(s, -1).T
+
+        # classical Gram-Schmidt twice keeps the extended basis orthonormal
+        P = self.U.T @ C
+        R = C - self.U @ P
+        P2 = self.U.T @ R
+        R -= self.U @ P2
+        P += P2
+        Q, Rr = np.linalg.qr(R)
+
+        r, m = self.B.shape
+        core = np.zeros((r + s, m + s), self.B.dtype)
+        core[:r, :m] = self.B
+        core[:r, m:] = P
+        core[r:, m:] = Rr
+        core = core[:, s:]
+        self.norms2 = np.concatenate((self.norms2[s:], np.sum(C ** 2, axis=0, dtype=np.float64)))
+
+        Ub, S, Vt = np.linalg.svd(core, full_matrices=False)
+        r = select_rank(S, self.rank, self.energy, total_energy=np.sum(self.norms2), thr=SVD_THRESHOLD)
+        self.U = np.hstack((self.U, Q)) @ Ub[:, :r]
+        self.B = S[:r, None] * Vt[:r]
+        self.keys = self.keys[1:] + [key]
+        self.updates += 1
+        return self
+
+    def operator(self):
+        '''
+        Reduced DMD operator: least squares map from every snapshot of the window to the next one
+        '''
+        X, Xprime = self.B[:, :-1], self.B[:, 1:]
+        return np.linalg.lstsq(X.T, Xprime.T, rcond=None)[0].T
+
+    def predict(self, n_pred_days=1, method='power'):
+        '''
+        Same maps as DMD_prediction: n_pred_days days of steps after the last snapshot,
+        the first n_daily_samples of them dropped (method, see reduced_forecast)
+        '''
+        n_samples = n_pred_days * self.n_daily_samples
+        states = reduced_forecast(self.operator(), self.B[:, -1], n_samples, method)
+        pred_maps = states[self.n_daily_samples:] @ self.U.T
+        return pred_maps.reshape(-1, *self.shape[1:])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with atomic_write(path, mode='wb', overwrite=True) as f:
+            np.savez(f, U=self.U, B=self.B, norms2=self.norms2, shape=np.array(self.shape),
+                     n_daily_samples=self.n_daily_samples, rank=-1 if self.rank is None else self.rank,
+                     energy=np.nan if self.energy is None else self.energy,
+                     keys=np.array(['' if key is None else key for key in self.keys]), updates=self.updates)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as state:
+            rank, energy = int(state['rank']), float(state['energy'])
+            return cls(state['U'], state['B'], state['norms2'], state['shape'].tolist(), int(state['n_daily_samples']),
+                       None if rank < 0 else rank, None if np.isnan(energy) else energy,
+                       [key or None for key in state['keys'].tolist()], int(state['updates']))
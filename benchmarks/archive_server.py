@@ -0,0 +1,209 @@
+import gzip
+import time
+import random
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, unquote
+
+import ncompress
+
+BANDWIDTH_CHUNK_SIZE = 16 * 1024
+
+
+def synthetic_product(name, size):
+    '''
+    Compressed bytes of a text product of roughly size decompressed bytes, .gz or .Z by name
+    '''
+    seed = int(hashlib.sha1(name.encode()).hexdigest()[:8], 16)
+    rng = random.Random(seed)
+    header = '{:<60}{:<20}\n'.format(name, 'SYNTHETIC PRODUCT').encode()
+    lines = [header]
+    n_bytes = len(header)
+    while n_bytes < size:
+        # numeric columns compress about as well as the real IONEX/SP3/RINEX text
+        line = ''.join('{:5d}'.format(rng.randint(-999, 9999)) for _ in range(16)).encode() + b'\n'
+        lines.append(line)
+        n_bytes += len(line)
+    data = b''.join(lines)
+
+    if name.endswith('.gz'):
+        return gzip.compress(data)
+    if name.endswith('.Z'):
+        return ncompress.compress(data)
+    return data
+
+
+class _ArchiveHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def _respond(self, send_body):
+        archive = self.server.archive
+        path = unquote(urlsplit(self.path).path)
+        time.sleep(archive.latency)
+
+        if archive.inject_failure():
+            archive.count('busy')
+            headers = {} if archive.retry_after is None else {'Retry-After': str(archive.retry_after)}
+            return self._send(503, b'busy', headers, send_body)
+
+        if path.endswith('/'):
+            return self._send_listing(path, send_body)
+
+        data = archive.files.get(path)
+        if data is None:
+            archive.count('missing')
+            return self._send(404, b'not found', {}, send_body)
+
+        etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+        status, offset = 200, 0
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header and range_header.startswith('bytes=') and (if_range is None or if_range == etag):
+            offset = int(range_header[len('bytes='):].split('-')[0])
+            if offset >= len(data):
+                return self._send(416, b'', {'Content-Range': 'bytes */{}'.format(len(data))}, send_body)
+            status = 206
+
+        body = data[offset:]
+        headers = {'ETag': etag}
+        if status == 206:
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(offset, len(data) - 1, len(data))
+        self._send(status, body, headers, send_body, may_drop=True)
+
+    def _send_listing(self, path, send_body):
+        archive = self.server.archive
+        names = archive.listing(path)
+        if names is None:
+            archive.count('missing')
+            return self._send(404, b'not found', {}, send_body)
+        archive.count('listing')
+        links = ''.join('<a href="{0}">{0}</a>\n'.format(name) for name in sorted(names))
+        body = '<html><body>\n{}</body></html>\n'.format(links).encode()
+        self._send(200, body, {'Content-Type': 'text/html'}, send_body)
+
+    def _send(self, status, body, headers, send_body, may_drop=False):
+        archive = self.server.archive
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if not send_body:
+            archive.count('head')
+            return
+
+        drop = may_drop and archive.inject_drop()
+        if drop:
+            # half the body, then the connection goes away
+            body = body[:len(body) // 2]
+            self.close_connection = True
+            archive.count('dropped')
+
+        for start in range(0, len(body), BANDWIDTH_CHUNK_SIZE):
+            chunk = body[start:start + BANDWIDTH_CHUNK_SIZE]
+            self.wfile.write(chunk)
+            if archive.bandwidth:
+                time.sleep(len(chunk) / archive.bandwidth)
+        archive.count('bytes_sent', len(body))
+        if status in (200, 206) and not drop:
+            archive.count('served')
+
+
+class _ArchiveHTTPServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients hanging up (cancelled or timed out downloads) are part of the game
+        pass
+
+
+class ArchiveServer(object):
+    '''
+    Local stand-in for the CDDIS / Garner https archives.
+
+    files maps url paths ('/archive/gnss/products/2200/igs22000.sp3.Z') to the compressed
+    bytes served for them, folders answer with an html index of their files. latency (s)
+    is added before every answer, bandwidth (bytes/s) caps every connection, failure_rate
+    answers 503 and drop_rate cuts a file transfer halfway.
+
+        with ArchiveServer(files) as server:
+            utils.CDDIS_PRODUCTS_URL = server.url + '/archive/gnss/products'
+    '''
+
+    def __init__(self, files=None, latency=0.0, bandwidth=None, failure_rate=0.0, drop_rate=0.0, retry_after=0, seed=0):
+        self.files = {}
+        self.folders = {}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.add_files(files or {})
+
+        self.httpd = None
+        self.thread = None
+
+    def add_files(self, files):
+        with self.lock:
+            for path, data in files.items():
+                self.files[path] = data
+                folder, name = path.rsplit('/', 1)
+                self.folders.setdefault(folder + '/', set()).add(name)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def listing(self, folder):
+        return self.folders.get(folder)
+
+    def inject_failure(self):
+        with self.lock:
+            return self.random.random() < self.failure_rate
+
+    def inject_drop(self):
+        with self.lock:
+            return self.random.random() < self.drop_rate
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def reset_counters(self):
+        with self.lock:
+            self.counters = {}
+
+    def start(self):
+        self.httpd = _ArchiveHTTPServer(('127.0.0.1', 0), _ArchiveHandler)
+        self.httpd.archive = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd is None: return
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,146 @@
+'''
+Speed and accuracy of the DMD SVD backends on a DMD_prediction window.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.dmd_benchmark --days 120 --energy 0.999 0.9999 --rank 100 300
+    python -m benchmarks.dmd_benchmark --files ION/IGS0OPSFIN_2022*_GIM.INX
+
+Without --files the window is synthetic (a few travelling diurnal patterns plus noise
+on the 71 x 73 grid). Every backend / rank setting is compared with the exact path:
+time and peak memory of DMD_prediction, modes kept, and RMSE / max abs difference
+of its predicted maps against the exact prediction. Synthetic windows also report the
+RMSE against the maps that really follow the window.
+
+--streaming adds StreamingDMD rows for every rank: the model is fitted on the window
+shifted one day back, the timed part is sliding it by the last day and predicting.
+--float32 runs every row again on float32 maps, still compared with the float64 exact path.
+'''
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+
+import DMD.algorithms_dmd as dmd
+from DMD.online_dmd import StreamingDMD
+from DMD.map_ingest import ingest_maps, fill_from_previous, DAILY_MAPS, MAP_SHAPE
+
+
+def synthetic_window(n_days, seed=0):
+    rng = np.random.default_rng(seed)
+    n_lat, n_lon = MAP_SHAPE
+    lats = np.linspace(87.5, -87.5, n_lat)[:, None]
+    lons = np.linspace(-180, 180, n_lon)[None, :]
+    hours = np.arange(n_days * DAILY_MAPS) * 24.0 / (DAILY_MAPS - 1)
+    maps = np.zeros((len(hours), n_lat, n_lon))
+    for k in range(6):
+        amplitude = rng.uniform(1, 10) * (1 + 0.2 * np.sin(2 * np.pi * hours / rng.uniform(200, 700)))
+        width = rng.uniform(20, 60)
+        for i, hour in enumerate(hours):
+            # a pattern that follows the sun around the globe
+            lon0 = (180 - 15 * hour * (k % 2 + 1) + rng.uniform(-5, 5)) % 360 - 180
+            maps[i] += amplitude[i] * np.exp(-((lons - lon0) / width) ** 2 - (lats / (width + 10)) ** 2)
+    maps += rng.normal(0, 0.3, maps.shape)
+    return np.abs(maps).reshape(n_days, DAILY_MAPS, n_lat, n_lon)
+
+
+def file_window(file_paths):
+    cube, ok = ingest_maps(sorted(file_paths), 'RMS', max_value=998)
+    first = fill_from_previous(cube, ok)
+    return cube[first:]
+
+
+def run_backend(maps, n_pred_days, svd, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    predicted = dmd.DMD_prediction(maps, n_pred_days=n_pred_days, svd=svd, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return predicted, elapsed, peak
+
+
+def run_streaming(maps, n_pred_days, rank):
+    # one day before the window, slid by its last day like a daily run
+    previous = np.concatenate((maps[:1], maps[:-1]))
+    model = StreamingDMD.fit(previous, rank=rank)
+    tracemalloc.start()
+    start = time.perf_counter()
+    predicted = model.update(maps[-1]).predict(n_pred_days)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return predicted, elapsed, peak, model.B.shape[0]
+
+
+def modes_kept(maps, svd, **kwargs):
+    d, s, h, w = maps.shape
+    X = maps.reshape(d * s, h * w).T[:, :-1]
+    return len(dmd.truncated_svd(X, svd, **kwargs)[1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=120, help='days of the synthetic window')
+    parser.add_argument('--files', nargs='*', default=None, help='IONEX files of the window, RMS maps are used')
+    parser.add_argument('--pred-days', type=int, default=2, help='DMD_prediction drops the first predicted day')
+    parser.add_argument('--energy', type=float, nargs='*', default=[0.999, 0.9999])
+    parser.add_argument('--rank', type=int, nargs='*', default=[100])
+    parser.add_argument('--backends', nargs='*', default=['exact', 'randomized', 'snapshots'])
+    parser.add_argument('--streaming', action='store_true', help='also time a one day StreamingDMD update')
+    parser.add_argument('--float32', action='store_true', help='also run every setting in single precision')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    truth = None
+    if args.files:
+        maps = file_window(args.files)
+    else:
+        # the days after the window are what the prediction is scored against
+        maps = synthetic_window(args.days + args.pred_days, args.seed)
+        maps, truth = maps[:args.days], maps[args.days:].reshape(-1, *MAP_SHAPE)
+    print('window {} days x {} maps, X is {} x {}'.format(maps.shape[0], maps.shape[1], np.prod(maps.shape[2:]), maps.shape[0] * maps.shape[1] - 1))
+
+    def truth_rmse(predicted):
+        if truth is None: return float('nan')
+        # the synthetic maps are one continuous 2h series, DMD_prediction drops its first 12 steps
+        target = truth[DAILY_MAPS - 1:][:len(predicted)]
+        return float(np.sqrt(np.mean((predicted[:len(target)] - target) ** 2)))
+
+    reference, elapsed, peak = run_backend(maps, args.pred_days, 'exact')
+    print('{:<34} {:>6} {:>9} {:>9} {:>10} {:>10} {:>10}'.format('backend', 'modes', 'seconds', 'peak MB', 'rmse', 'max abs', 'rmse true'))
+    print('{:<34} {:>6} {:>9.2f} {:>9.1f} {:>10} {:>10} {:>10.4f}'.format('exact (all modes)', modes_kept(maps, 'exact'), elapsed, peak / 1e6, '-', '-', truth_rmse(reference)))
+
+    def report(name, predicted, **result):
+        difference = predicted - reference
+        result.update(rmse=float(np.sqrt(np.mean(difference ** 2))), max_abs=float(np.max(np.abs(difference))),
+                      rmse_truth=truth_rmse(predicted))
+        print('{:<34} {modes:>6} {seconds:>9.2f} {peak_mb:>9.1f} {rmse:>10.4f} {max_abs:>10.4f} {rmse_truth:>10.4f}'.format(name, **result))
+        return result
+
+    settings = [{'energy': energy} for energy in args.energy] + [{'rank': rank} for rank in args.rank]
+    results = []
+    for dtype in [np.float64] + ([np.float32] if args.float32 else []):
+        window = maps.astype(dtype, copy=False)
+        prefix = '' if dtype == np.float64 else 'float32 '
+        if dtype != np.float64:
+            predicted, elapsed, peak = run_backend(window, args.pred_days, 'exact')
+            results.append(report(prefix + 'exact (all modes)', predicted, svd='exact', dtype='float32',
+                                  modes=modes_kept(window, 'exact'), seconds=elapsed, peak_mb=peak / 1e6))
+        for svd in args.backends:
+            for setting in settings:
+                predicted, elapsed, peak = run_backend(window, args.pred_days, svd, **setting)
+                name = '{}{} {}'.format(prefix, svd, ', '.join('{}={}'.format(k, v) for k, v in setting.items()))
+                results.append(report(name, predicted, svd=svd, dtype=np.dtype(dtype).name, modes=modes_kept(window, svd, **setting),
+                                      seconds=elapsed, peak_mb=peak / 1e6, **setting))
+        if args.streaming:
+            for rank in args.rank:
+                predicted, elapsed, peak, modes = run_streaming(window, args.pred_days, rank)
+                results.append(report('{}streaming update, rank={}'.format(prefix, rank), predicted, svd='streaming',
+                                      dtype=np.dtype(dtype).name, modes=modes, seconds=elapsed, peak_mb=peak / 1e6, rank=rank))
+    return results
+
+
+if __name__ == '__main__':
+    main()
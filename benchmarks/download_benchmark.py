@@ -0,0 +1,202 @@
+'''
+Offline benchmark of the download subsystem against benchmarks/archive_server.py.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.download_benchmark --dates 30 --stations bogt braz --latency 0.05 --concurrency 8 32
+
+Every run works in a fresh temporary folder (ION/, SP3/, CLK/, RNX/, TEMP/ are relative paths)
+and reports, per concurrency level:
+    planning cold   plan_campaign with empty listing caches (listing/HEAD round trips)
+    planning warm   plan_campaign again, listings come from TEMP/listings
+    campaign        download_campaign end to end, files/s and MB/s (compressed on the wire)
+    rerun           download_campaign once every product is on disk
+--ionexv2 adds the IONEXv2.download_ionex_by_date_list priority lists (needs the DMD dependencies).
+'''
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import datetime
+import tempfile
+from urllib.parse import urlsplit
+
+from benchmarks.archive_server import ArchiveServer, synthetic_product
+import utilities.utils as utils
+import utilities.throttle as throttle
+
+CDDIS_PRODUCTS_PATH = '/archive/gnss/products'
+GARNER_RINEX_PATH = '/archive/garner/rinex'
+PRODUCT_TYPES = [utils.ION_root, utils.SP3_root, utils.CLK_root, utils.RNX_root]
+IONEXV2_FOLDER = 'IONEXv2'
+
+IONEXv2 = None
+
+
+def point_archives_at(server_url):
+    utils.CDDIS_PRODUCTS_URL = server_url + CDDIS_PRODUCTS_PATH
+    utils.CDDIS_IONEX_URL = utils.CDDIS_PRODUCTS_URL + '/ionex'
+    utils.GARNER_RINEX_URL = server_url + GARNER_RINEX_PATH
+    if IONEXv2 is not None:
+        IONEX.BASE_URL = utils.CDDIS_IONEX_URL
+
+
+def campaign_urls(stations, dates_list, agencies_list):
+    '''
+    Every url the campaign planners may ask for, sp3 candidates of all priorities included
+    '''
+    urls = [d['url'] for d in utils.plan_ionex_v2(dates_list, agencies_list).values()]
+    urls += [d['url'] for d in utils.plan_clk(dates_list).values()]
+    for station in stations:
+        urls += [d['url'] for d in utils.plan_rinex(station, dates_list).values()]
+    for candidates in utils.plan_sp3_v2(dates_list):
+        urls += [d['url'] for _, d in candidates]
+    return sorted(set(urls))
+
+
+def ionexv2_urls(dates_list):
+    ionex = IONEXv2(IONEXV2_FOLDER)
+    return sorted(set(d['url'] for date in dates_list for _, d in ionex._get_prioritized_candidates(date)))
+
+
+def build_archive(urls, product_size, missing_rate, seed):
+    '''
+    {url path: compressed bytes}, a missing_rate fraction of the urls is left out
+    '''
+    rng = random.Random(seed)
+    files = {}
+    for url in urls:
+        if rng.random() < missing_rate: continue
+        path = urlsplit(url).path
+        files[path] = synthetic_product(path.rsplit('/', 1)[1], product_size)
+    return files
+
+
+def _timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run_once(server, stations, dates_list, agencies_list, max_concurrency):
+    # learned host limits and cached listings must not leak between runs
+    throttle._HOST_STATS.clear()
+    shutil.rmtree(utils.TEMP_root, ignore_errors=True)
+    for folder in PRODUCT_TYPES + [IONEXV2_FOLDER]:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    result = {'max_concurrency': max_concurrency}
+
+    server.reset_counters()
+    (planned, available), result['planning_cold_s'] = _timed(
+        utils.plan_campaign, stations, dates_list, agencies_list, PRODUCT_TYPES, max_concurrency=max_concurrency)
+    result['planning_requests'] = dict(server.counters)
+    _, result['planning_warm_s'] = _timed(
+        utils.plan_campaign, stations, dates_list, agencies_list, PRODUCT_TYPES, max_concurrency=max_concurrency)
+    result['planned'] = len(planned)
+    result['available'] = len(available)
+
+    server.reset_counters()
+    report, elapsed = _timed(
+        utils.download_campaign, stations, dates_list, agencies_list, PRODUCT_TYPES, max_concurrency=max_concurrency)
+    counters = dict(server.counters)
+    n_files = len(report['downloaded'])
+    wire_mb = counters.get('bytes_sent', 0) / 1e6
+    disk_mb = sum(os.path.getsize(file_path) for file_path in report['downloaded']) / 1e6
+    result.update({
+        'campaign_s': elapsed,
+        'downloaded': n_files,
+        'missing': len(report['missing']),
+        'files_per_s': n_files / elapsed,
+        'wire_mb_per_s': wire_mb / elapsed,
+        'disk_mb_per_s': disk_mb / elapsed,
+        'campaign_requests': counters,
+    })
+
+    _, result['rerun_s'] = _timed(
+        utils.download_campaign, stations, dates_list, agencies_list, PRODUCT_TYPES, max_concurrency=max_concurrency)
+
+    if IONEXv2 is not None:
+        server.reset_counters()
+        results, elapsed = _timed(
+            IONEXv2(IONEXV2_FOLDER).download_ionex_by_date_list, dates_list, max_concurrency=max_concurrency)
+        n_files = len([r for r in results if r is not None])
+        result.update({
+            'ionexv2_s': elapsed,
+            'ionexv2_files_per_s': n_files / elapsed,
+            'ionexv2_wire_mb_per_s': server.counters.get('bytes_sent', 0) / 1e6 / elapsed,
+            'ionexv2_requests': dict(server.counters),
+        })
+    return result
+
+
+def print_result(result):
+    print('concurrency {max_concurrency:>3}: planned {planned}, available {available}, downloaded {downloaded}, missing {missing}'.format(**result))
+    print('    planning cold {planning_cold_s:7.3f}s   warm {planning_warm_s:7.3f}s'.format(**result))
+    print('    campaign      {campaign_s:7.3f}s   {files_per_s:8.1f} files/s   {wire_mb_per_s:7.2f} MB/s wire   {disk_mb_per_s:7.2f} MB/s disk'.format(**result))
+    print('    rerun         {rerun_s:7.3f}s'.format(**result))
+    print('    requests      planning {}   campaign {}'.format(result['planning_requests'], result['campaign_requests']))
+    if 'ionexv2_s' in result:
+        print('    IONEXv2       {ionexv2_s:7.3f}s   {ionexv2_files_per_s:8.1f} files/s   {ionexv2_wire_mb_per_s:7.2f} MB/s wire   {ionexv2_requests}'.format(**result))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--start', default='2022-01-01', help='first date, YYYY-MM-DD')
+    parser.add_argument('--dates', type=int, default=14, help='number of consecutive dates')
+    parser.add_argument('--stations', nargs='*', default=['bogt', 'braz', 'chpi'])
+    parser.add_argument('--agencies', nargs='*', default=['igs', 'ckm'])
+    parser.add_argument('--product-size', type=int, default=256 * 1024, help='decompressed bytes per product')
+    parser.add_argument('--missing-rate', type=float, default=0.2, help='fraction of products absent from the archive')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added before every answer')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes/s per connection')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of requests answered 503')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='fraction of transfers cut halfway')
+    parser.add_argument('--concurrency', type=int, nargs='*', default=[utils.MAX_CONCURRENT_DOWNLOADS])
+    parser.add_argument('--ionexv2', action='store_true', help='also benchmark IONEXv2.download_ionex_by_date_list')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='json file the results are written to')
+    args = parser.parse_args(argv)
+
+    global IONEX, IONEXv2
+    if args.ionexv2:
+        import DMD.IONEX as IONEX
+        IONEXv2 = IONEX.IONEXv2
+
+    start = datetime.datetime.strptime(args.start, '%Y-%m-%d')
+    dates_list = [start + datetime.timedelta(days=i) for i in range(args.dates)]
+
+    work_dir = tempfile.mkdtemp(prefix='download_benchmark_')
+    cwd = os.getcwd()
+    results = []
+    try:
+        os.chdir(work_dir)
+        server = ArchiveServer(latency=args.latency, bandwidth=args.bandwidth, failure_rate=args.failure_rate,
+                               drop_rate=args.drop_rate, seed=args.seed)
+        with server:
+            point_archives_at(server.url)
+            urls = campaign_urls(args.stations, dates_list, args.agencies)
+            if IONEXv2 is not None:
+                urls += ionexv2_urls(dates_list)
+            server.add_files(build_archive(urls, args.product_size, args.missing_rate, args.seed))
+            print('{} products ({:.1f} MB compressed) on {}'.format(
+                len(server.files), sum(map(len, server.files.values())) / 1e6, server.url))
+
+            for max_concurrency in args.concurrency:
+                result = run_once(server, args.stations, dates_list, args.agencies, max_concurrency)
+                print_result(result)
+                results.append(result)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=1)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,723 @@
+import io
+import os
+import re
+import json
+import time
+import zlib
+import asyncio
+import hashlib
+import logging
+import subprocess
+import threading
+from importlib import resources
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import cpu_count
+
+import aiohttp
+import hatanaka
+import ncompress
+import requests
+from atomicwrites import atomic_write
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.exceptions import HTTPError as Urllib3Error
+
+from utilities.throttle import (Throttler, ServerBusy, raise_for_busy, host_stats, latency_trace_config,
+                                retrying, retrying_sync, ASYNC_TRANSIENT_ERRORS, NETWORK_ERRORS)
+from utilities import telemetry
+
+HTTP_POOL_CONNECTIONS = 4   # number of hosts kept alive per worker (cddis, garner, ...)
+HTTP_POOL_MAXSIZE = 4       # keep-alive connections per host per worker
+HTTP_TIMEOUT = (10, 60)     # (connect, read) seconds
+N_DOWNLOAD_ATTEMPTS = 3
+
+_SESSIONS = {}
+
+
+def get_session():
+    '''
+    Returns the keep-alive requests.Session of the current process.
+
+    Sessions are keyed by pid, so every multiprocessing.Pool worker builds its
+    own pool on first use instead of sharing the sockets inherited from the parent.
+    '''
+    pid = os.getpid()
+    session = _SESSIONS.get(pid)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                              pool_maxsize=HTTP_POOL_MAXSIZE,
+                              pool_block=True)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _SESSIONS.clear()
+        _SESSIONS[pid] = session
+    return session
+
+
+def http_head(url, verify=True):
+    response = get_session().head(url, verify=verify, timeout=HTTP_TIMEOUT)
+    host_stats(url).observe_latency(response.elapsed.total_seconds())
+    return response
+
+
+def http_get(url, verify=True, stream=False, headers=None):
+    response = get_session().get(url, verify=verify, stream=stream, headers=headers, timeout=HTTP_TIMEOUT)
+    host_stats(url).observe_latency(response.elapsed.total_seconds())
+    return response
+
+
+SYNC_TRANSIENT_ERRORS = (requests.RequestException, Urllib3Error) + NETWORK_ERRORS
+
+
+##################################
+#     STREAMING DECOMPRESSION
+##################################
+
+STREAM_CHUNK_SIZE = 64 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+LZW_MAGIC = b'\x1f\x9d'
+CRX_MARKER = b'COMPACT RINEX'
+RINEX_HEADER_LABEL_LEN = 80
+
+
+class _PrefixedReader(object):
+    '''
+    File-like reader that replays the sniffed magic bytes before the rest of the stream
+    '''
+    def __init__(self, prefix, fsrc):
+        self.prefix = prefix
+        self.fsrc = fsrc
+
+    def read(self, n=-1):
+        if not self.prefix:
+            return self.fsrc.read(n)
+        if n is None or n < 0:
+            data, self.prefix = self.prefix + self.fsrc.read(), b''
+            return data
+        data, self.prefix = self.prefix[:n], self.prefix[n:]
+        if len(data) < n:
+            data += self.fsrc.read(n - len(data))
+        return data
+
+
+class _RinexSink(object):
+    '''
+    Writes decompressed chunks into f.
+
+    Hatanaka compressed content (COMPACT RINEX header) is piped through the
+    crx2rnx executable shipped with the hatanaka package; a reader thread copies its
+    output into f, which can be any object with write() (BytesIO, _NullSink).
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.head = b''
+        self.proc = None
+        self.reader = None
+        self.reader_error = None
+        self.started = False
+
+    def _copy_output(self):
+        try:
+            for chunk in iter(lambda: self.proc.stdout.read(STREAM_CHUNK_SIZE), b''):
+                self.f.write(chunk)
+        except Exception as e:
+            self.reader_error = e
+            # keeps crx2rnx from blocking on a full pipe
+            for _ in iter(lambda: self.proc.stdout.read(STREAM_CHUNK_SIZE), b''): pass
+
+    def _start(self):
+        self.started = True
+        if CRX_MARKER in self.head[:RINEX_HEADER_LABEL_LEN]:
+            crx2rnx = resources.files('hatanaka.bin').joinpath('crx2rnx')
+            self.proc = subprocess.Popen([str(crx2rnx), '-'], stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            self.reader = threading.Thread(target=self._copy_output, daemon=True)
+            self.reader.start()
+        head, self.head = self.head, b''
+        self._write(head)
+
+    def _write(self, chunk):
+        if self.proc is None:
+            self.f.write(chunk)
+        else:
+            self.proc.stdin.write(chunk)
+
+    def write(self, chunk):
+        if not chunk: return 0
+        if not self.started:
+            self.head += chunk
+            if len(self.head) >= RINEX_HEADER_LABEL_LEN:
+                self._start()
+        else:
+            self._write(chunk)
+        return len(chunk)
+
+    def close(self):
+        if not self.started:
+            self._start()
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.reader.join()
+            self.proc.stdout.close()
+            retcode = self.proc.wait()
+            if self.reader_error is not None:
+                raise self.reader_error
+            if retcode not in (0, 2):
+                raise hatanaka.HatanakaException('crx2rnx exited with code {}'.format(retcode))
+
+
+def decompress_stream(fsrc, fdst, chunk_size=STREAM_CHUNK_SIZE):
+    '''
+    Incrementally decompresses .Z / .gz (and Hatanaka CRX inside them) from fsrc into fdst.
+
+    Only chunk_size bytes of the compressed stream are held in memory at a time.
+    '''
+    head = fsrc.read(2)
+    reader = _PrefixedReader(head, fsrc)
+    sink = _RinexSink(fdst)
+
+    if head == LZW_MAGIC:
+        ncompress.decompress(reader, sink)
+    elif head == GZIP_MAGIC:
+        decompressor = zlib.decompressobj(wbits=31)
+        for chunk in iter(lambda: reader.read(chunk_size), b''):
+            while chunk:
+                sink.write(decompressor.decompress(chunk))
+                chunk = b''
+                if decompressor.eof:
+                    # concatenated gzip members
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(wbits=31)
+        sink.write(decompressor.flush())
+    else:
+        for chunk in iter(lambda: reader.read(chunk_size), b''):
+            sink.write(chunk)
+
+    sink.close()
+
+
+def decompress_file(zipped_file_path, file_path):
+    '''
+    Streams a compressed file on disk into its atomic_write target
+    '''
+    with open(zipped_file_path, 'rb') as fsrc:
+        with atomic_write(file_path, mode='wb', overwrite=True) as fdst:
+            decompress_stream(fsrc, fdst)
+    return file_path
+
+
+class _NullSink(object):
+
+    def write(self, chunk):
+        return len(chunk)
+
+    def flush(self):
+        pass
+
+
+def check_compressed_file(zipped_file_path):
+    '''
+    Decompresses the file without writing anything, raises when it is corrupt
+    '''
+    with open(zipped_file_path, 'rb') as fsrc:
+        decompress_stream(fsrc, _NullSink())
+
+
+def read_decompressed(file_path):
+    '''
+    Content of a product file, .Z / .gz ones are decompressed in memory while they are read
+    '''
+    with open(file_path, 'rb') as fsrc:
+        head = fsrc.read(2)
+        if head not in (LZW_MAGIC, GZIP_MAGIC):
+            return head + fsrc.read()
+        fdst = io.BytesIO()
+        decompress_stream(_PrefixedReader(head, fsrc), fdst)
+    return fdst.getvalue()
+
+
+COMPRESSED_SUFFIXES = ('.Z', '.gz')
+
+
+def is_compressed_url(url):
+    return os.path.splitext(urlsplit(url).path)[1] in COMPRESSED_SUFFIXES
+
+
+def check_compressed_head(file_path):
+    '''
+    Raises when file_path does not start like a .Z / .gz file (e.g. a login or error page)
+    '''
+    with open(file_path, 'rb') as f:
+        head = f.read(2)
+    if head not in (LZW_MAGIC, GZIP_MAGIC):
+        raise ValueError('{} is not .Z / .gz content'.format(file_path))
+
+
+def compressed_path(file_path, url):
+    '''
+    Where a product is kept when it is not decompressed: the archive's file name in the folder
+    of file_path (file_path plus .Z / .gz for IONEX, Hatanaka RINEX keeps its .YYd.Z name)
+    '''
+    if not is_compressed_url(url): return file_path
+    return os.path.join(os.path.dirname(file_path), os.path.basename(urlsplit(url).path))
+
+
+##################################
+#   RESUMABLE PARTIAL DOWNLOADS
+##################################
+
+PART_SUFFIX = '.part'               # compressed bytes received so far, kept beside the target
+PART_META_SUFFIX = '.part.json'     # ETag / Last-Modified of the partial, sent back as If-Range
+
+
+class MissingRemoteFile(Exception):
+    pass
+
+
+def part_paths(file_path):
+    return '{}{}'.format(file_path, PART_SUFFIX), '{}{}'.format(file_path, PART_META_SUFFIX)
+
+
+def remove_part(file_path):
+    for path in part_paths(file_path):
+        if os.path.isfile(path): os.remove(path)
+
+
+def _resume_headers(file_path):
+    '''
+    Range and If-Range headers continuing the partial of file_path, returns (offset, headers).
+    Without an ETag / Last-Modified the server cannot tell whether the partial is stale,
+    it is dropped and the download starts over.
+    '''
+    part_path, meta_path = part_paths(file_path)
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    if offset == 0: return 0, {}
+    try:
+        with open(meta_path) as f:
+            validator = json.load(f).get('validator')
+    except (OSError, ValueError):
+        validator = None
+    if not validator:
+        remove_part(file_path)
+        return 0, {}
+    return offset, {'Range': 'bytes={}-'.format(offset), 'If-Range': validator}
+
+
+def _open_part(file_path, status, offset, response_headers):
+    '''
+    206 appends to the partial, 200 (new file or changed on the server) starts it over
+    '''
+    part_path, meta_path = part_paths(file_path)
+    if status == 206 and offset > 0:
+        return open(part_path, 'ab')
+    validator = response_headers.get('ETag') or response_headers.get('Last-Modified')
+    with open(meta_path, 'w') as f:
+        json.dump({'validator': validator}, f)
+    return open(part_path, 'wb')
+
+
+def _check_part_status(status, offset, headers):
+    '''
+    True when the partial is already complete (416 on a resumed range)
+    '''
+    if status == 416 and offset > 0:
+        return True
+    raise_for_busy(status, headers)
+    if status not in (200, 206):
+        raise MissingRemoteFile(status)
+    return False
+
+
+def finalize_part(url, file_path, keep_compressed=False):
+    '''
+    Decompresses the finished partial into file_path.
+    With keep_compressed the partial is only checked and becomes file_path as it is.
+    A partial that does not decompress, or that is not compressed while the url
+    says .Z / .gz, is dropped so the next run starts over.
+    '''
+    part_path, _ = part_paths(file_path)
+    try:
+        if is_compressed_url(url): check_compressed_head(part_path)
+        if keep_compressed:
+            check_compressed_file(part_path)
+            os.replace(part_path, file_path)
+        else:
+            decompress_file(part_path, file_path)
+    finally:
+        remove_part(file_path)
+    return file_path
+
+
+def _finalize_part_timed(url, file_path, keep_compressed=False):
+    '''
+    finalize_part for the telemetry, returns (decompression seconds, bytes on disk)
+    '''
+    start = time.monotonic()
+    finalize_part(url, file_path, keep_compressed)
+    return time.monotonic() - start, os.path.getsize(file_path)
+
+
+def _local_product(url, file_path, keep_compressed):
+    '''
+    (path the product is saved to, path of a copy already on disk or None)
+    '''
+    target = compressed_path(file_path, url) if keep_compressed else file_path
+    for path in (file_path, target):
+        if os.path.isfile(path): return target, path
+    return target, None
+
+
+def _download_part_sync(url, file_path, verify, record):
+    record.attempts += 1
+    offset, headers = _resume_headers(file_path)
+    start = time.monotonic()
+    with http_get(url, verify=verify, stream=True, headers=headers) as response:
+        record.ttfb = time.monotonic() - start
+        record.http_status = response.status_code
+        if _check_part_status(response.status_code, offset, response.headers): return
+        start = time.monotonic()
+        with _open_part(file_path, response.status_code, offset, response.headers) as f:
+            for chunk in response.raw.stream(STREAM_CHUNK_SIZE, decode_content=False):
+                f.write(chunk)
+                record.compressed_bytes += len(chunk)
+        record.transfer_time = time.monotonic() - start
+
+
+def fetch_and_decompress(url, file_path, verify=True, keep_compressed=False):
+    '''
+    Blocking download of url into file_path.
+
+    The compressed bytes are kept in file_path.part while they arrive, so an interrupted
+    transfer is resumed with a Range request, then streamed through the decompressor.
+    keep_compressed saves the product as it came instead (file_path plus the .Z / .gz
+    suffix of the url), either copy already on disk counts as downloaded.
+    Returns the saved path, or None when the url is missing or every attempt failed.
+    '''
+    file_path, local_path = _local_product(url, file_path, keep_compressed)
+    record = telemetry.new_fetch(url, file_path)
+    if local_path is not None:
+        record.status = 'cached'
+        return local_path
+
+    try:
+        # the partial is kept between attempts, each one resumes from its end
+        retrying_sync(url, lambda: _download_part_sync(url, file_path, verify, record), N_DOWNLOAD_ATTEMPTS, SYNC_TRANSIENT_ERRORS)
+    except MissingRemoteFile:
+        record.status = 'missing'
+        return None
+    except (ServerBusy,) + SYNC_TRANSIENT_ERRORS:
+        record.status = 'failed'
+        return None
+    except OSError:
+        # local (e.g. disk full), not retried and not held against the host
+        record.status = 'failed'
+        return None
+
+    try:
+        record.decompress_time, record.decompressed_bytes = _finalize_part_timed(url, file_path, keep_compressed)
+    except Exception:
+        record.status = 'corrupt'
+        return None
+    record.status = 'ok'
+    return file_path
+
+
+##################################
+#        ASYNC DOWNLOADS
+##################################
+
+MAX_CONCURRENT_DOWNLOADS = 32          # sockets in flight at once
+MAX_CONCURRENT_PER_HOST = 16
+DECOMPRESS_WORKERS = max(1, min(4, cpu_count() // 2))
+
+
+async def _download_part(session, url, file_path, record):
+    if record.attempts == 0:
+        record.queue_time = time.monotonic() - record.queued
+    record.attempts += 1
+    offset, headers = _resume_headers(file_path)
+    start = time.monotonic()
+    async with session.get(url, headers=headers) as response:
+        record.ttfb = time.monotonic() - start
+        record.http_status = response.status
+        if _check_part_status(response.status, offset, response.headers): return
+        start = time.monotonic()
+        with _open_part(file_path, response.status, offset, response.headers) as f:
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                f.write(chunk)
+                record.compressed_bytes += len(chunk)
+        record.transfer_time = time.monotonic() - start
+
+
+async def _fetch_and_save(session, throttler, executor, url, file_path, keep_compressed=False):
+
+    file_path, local_path = _local_product(url, file_path, keep_compressed)
+    record = telemetry.new_fetch(url, file_path)
+    if local_path is not None:
+        record.status = 'cached'
+        return local_path
+
+    # time spent waiting for a global or per host slot
+    record.queued = time.monotonic()
+    try:
+        # the partial is kept between attempts, each one resumes from its end
+        await retrying(throttler, url, lambda: _download_part(session, url, file_path, record), N_DOWNLOAD_ATTEMPTS)
+    except MissingRemoteFile:
+        record.status = 'missing'
+        return None
+    except ASYNC_TRANSIENT_ERRORS:
+        record.status = 'failed'
+        return None
+    except OSError:
+        # local (e.g. disk full), not retried and not held against the host
+        record.status = 'failed'
+        return None
+
+    # decompression runs in the executor, keeps the event loop free for sockets
+    loop = asyncio.get_running_loop()
+    try:
+        record.decompress_time, record.decompressed_bytes = await loop.run_in_executor(executor, _finalize_part_timed, url, file_path, keep_compressed)
+    except Exception:
+        record.status = 'corrupt'
+        return None
+    record.status = 'ok'
+    return file_path
+
+
+def _client_session(verify, max_concurrency):
+    connector_kwargs = {} if verify else {'ssl': False}
+    connector = aiohttp.TCPConnector(limit=max_concurrency, limit_per_host=MAX_CONCURRENT_PER_HOST, **connector_kwargs)
+    timeout = aiohttp.ClientTimeout(sock_connect=HTTP_TIMEOUT[0], sock_read=HTTP_TIMEOUT[1])
+    # trust_env: HTTP(S)_PROXY and the ~/.netrc credentials (Earthdata login of CDDIS)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[latency_trace_config()], trust_env=True)
+
+
+async def _download_files(files_to_download_dict, verify, max_concurrency, keep_compressed=False):
+
+    throttler = Throttler(max_concurrency)
+
+    with ProcessPoolExecutor(DECOMPRESS_WORKERS) as executor:
+        async with _client_session(verify, max_concurrency) as session:
+            tasks = [_fetch_and_save(session, throttler, executor, data_dict['url'], file_path, keep_compressed)
+                     for file_path, data_dict in files_to_download_dict.items()]
+            return await asyncio.gather(*tasks)
+
+
+def run_coroutine(coroutine):
+    '''
+    asyncio.run that also works from inside a running loop (jupyter notebooks)
+    '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()
+
+
+def download_files(files_to_download_dict, verify=True, max_concurrency=MAX_CONCURRENT_DOWNLOADS, keep_compressed=False):
+    '''
+    Fetches a download plan {file_path: {'url':..,'date':..}} with asyncio.
+
+    keep_compressed saves the products as .Z / .gz next to file_path (see fetch_and_decompress).
+    Returns the list of saved file paths (None for failed files) in plan order.
+    '''
+    if len(files_to_download_dict) == 0: return []
+    return run_coroutine(_download_files(files_to_download_dict, verify, max_concurrency, keep_compressed))
+
+
+##################################
+#     REMOTE DIRECTORY LISTINGS
+##################################
+
+LISTING_CACHE_DIR = os.path.join('TEMP','listings')
+LISTING_TTL = 6 * 60 * 60           # seconds before a cached folder listing is fetched again
+LISTING_SUFFIX = {
+    'cddis.nasa.gov': '/*?list',    # plain text "name size" listing
+}
+USE_REMOTE_LISTINGS = True
+
+
+def split_folder_url(url):
+    folder_url, file_name = url.rsplit('/', 1)
+    return folder_url, file_name
+
+
+class NotAListing(ValueError):
+    pass
+
+
+def parse_listing(text, plain=False):
+    '''
+    File names of a CDDIS "?list" response (plain) or of an html index page.
+    Raises NotAListing for anything else, e.g. the login page a listing request is redirected to.
+    '''
+    if text.lstrip().startswith('<'):
+        if plain or re.search(r'type=["\']?password', text, re.IGNORECASE):
+            raise NotAListing('html page instead of a folder listing')
+        return set(name for name in re.findall(r'href="([^"/?#]+)"', text))
+    names = set()
+    for line in text.splitlines():
+        if not line.strip() or line.startswith('#'): continue
+        fields = line.split()
+        if len(fields) != 2 or not fields[1].isdigit():
+            raise NotAListing('unexpected listing line {!r}'.format(line[:80]))
+        names.add(fields[0])
+    return names
+
+
+def _listing_cache_path(folder_url):
+    key = hashlib.sha1(folder_url.encode()).hexdigest()
+    return os.path.join(LISTING_CACHE_DIR, '{}.json'.format(key))
+
+
+def _load_cached_listing(folder_url, ttl):
+    cache_path = _listing_cache_path(folder_url)
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get('url') != folder_url or time.time() - cached.get('time', 0) > ttl:
+        return None
+    return set(cached['names'])
+
+
+def _save_cached_listing(folder_url, names):
+    os.makedirs(LISTING_CACHE_DIR, exist_ok=True)
+    with atomic_write(_listing_cache_path(folder_url), overwrite=True) as f:
+        json.dump({'url': folder_url, 'time': time.time(), 'names': sorted(names)}, f)
+
+
+async def _fetch_listing(session, throttler, folder_url, ttl):
+    '''
+    Returns the set of file names in folder_url, None when the server gives no usable listing
+    '''
+    names = _load_cached_listing(folder_url, ttl)
+    if names is not None:
+        telemetry.observe('listing', folder_url, 0.0, None, cached=True)
+        return names
+
+    host = urlsplit(folder_url).hostname
+    listing_url = folder_url + LISTING_SUFFIX.get(host, '/')
+
+    async def attempt():
+        start = time.monotonic()
+        async with session.get(listing_url) as response:
+            telemetry.observe('listing', listing_url, time.monotonic() - start, response.status)
+            raise_for_busy(response.status, response.headers)
+            if response.status != 200:
+                return None
+            if response.url.host != host:
+                raise NotAListing('redirected to {}'.format(response.url.host))
+            return await response.text(errors='ignore')
+    try:
+        text = await retrying(throttler, listing_url, attempt, N_DOWNLOAD_ATTEMPTS)
+        if text is None: return None
+        names = parse_listing(text, plain=host in LISTING_SUFFIX)
+    except ASYNC_TRANSIENT_ERRORS:
+        return None
+    except NotAListing as ex:
+        # not "no files": the candidates are kept and their downloads report what went wrong
+        logging.warning('No usable listing of %s: %s', folder_url, ex)
+        return None
+
+    _save_cached_listing(folder_url, names)
+    return names
+
+
+async def _fetch_listings(session, throttler, urls, ttl):
+    folder_urls = sorted(set(split_folder_url(url)[0] for url in urls))
+    listings = await asyncio.gather(*[_fetch_listing(session, throttler, folder_url, ttl) for folder_url in folder_urls])
+    return dict(zip(folder_urls, listings))
+
+
+def get_remote_listings(urls, verify=True, max_concurrency=MAX_CONCURRENT_DOWNLOADS, ttl=LISTING_TTL):
+    '''
+    One (cached) listing per distinct folder of urls : {folder_url: set of names or None}
+    '''
+    async def _run():
+        throttler = Throttler(max_concurrency)
+        async with _client_session(verify, max_concurrency) as session:
+            return await _fetch_listings(session, throttler, urls, ttl)
+    if len(urls) == 0: return {}
+    return run_coroutine(_run())
+
+
+def filter_available_files(files_to_download_dict, verify=True, max_concurrency=MAX_CONCURRENT_DOWNLOADS, ttl=LISTING_TTL):
+    '''
+    Drops the plan entries that their folder listing shows are not on the server
+    '''
+    if not USE_REMOTE_LISTINGS: return files_to_download_dict
+    listings = get_remote_listings([data_dict['url'] for data_dict in files_to_download_dict.values()],
+                                   verify=verify, max_concurrency=max_concurrency, ttl=ttl)
+    available = {}
+    for file_path, data_dict in files_to_download_dict.items():
+        folder_url, file_name = split_folder_url(data_dict['url'])
+        listing = listings.get(folder_url)
+        if listing is None or file_name in listing:
+            available[file_path] = data_dict
+    return available
+
+
+##################################
+#     PRIORITY LIST RESOLUTION
+##################################
+
+async def _probe(session, throttler, url):
+
+    async def attempt():
+        start = time.monotonic()
+        async with session.head(url) as response:
+            telemetry.observe('head', url, time.monotonic() - start, response.status)
+            raise_for_busy(response.status, response.headers)
+            return response.status == 200
+    try:
+        return await retrying(throttler, url, attempt, N_DOWNLOAD_ATTEMPTS)
+    except ASYNC_TRANSIENT_ERRORS:
+        return False
+
+
+async def _resolve_prioritized_files(prioritized_candidates, verify, max_concurrency, use_listings, ttl):
+
+    throttler = Throttler(max_concurrency)
+
+    async with _client_session(verify, max_concurrency) as session:
+
+        urls = [data_dict['url'] for candidates in prioritized_candidates for _, data_dict in candidates]
+        listings = await _fetch_listings(session, throttler, urls, ttl) if use_listings else {}
+
+        async def _is_available(url):
+            # resolved locally against the folder listing, HEAD only when there is none
+            folder_url, file_name = split_folder_url(url)
+            listing = listings.get(folder_url)
+            if listing is not None:
+                return file_name in listing
+            return await _probe(session, throttler, url)
+
+        probes = [[asyncio.ensure_future(_is_available(data_dict['url'])) for _, data_dict in candidates]
+                  for candidates in prioritized_candidates]
+        await asyncio.gather(*[p for candidate_probes in probes for p in candidate_probes])
+
+    files_to_download_dict = {}
+    for candidates, candidate_probes in zip(prioritized_candidates, probes):
+        for (file_path, data_dict), probe in zip(candidates, candidate_probes):
+            if probe.result():
+                files_to_download_dict[file_path] = data_dict
+                break
+    return files_to_download_dict
+
+
+def resolve_prioritized_files(prioritized_candidates, verify=True, max_concurrency=MAX_CONCURRENT_DOWNLOADS,
+                              use_listings=USE_REMOTE_LISTINGS, ttl=LISTING_TTL):
+    '''
+    prioritized_candidates : one list per date of (file_path, {'url':..,'date':..}), highest priority first.
+
+    Checks every candidate of every date at once, against one cached listing per
+    remote folder (HEAD probes where no listing is available), and returns the download
+    plan {file_path: {'url':..,'date':..}} holding the highest priority hit of each date.
+    '''
+    prioritized_candidates = [candidates for candidates in prioritized_candidates if len(candidates) > 0]
+    if len(prioritized_candidates) == 0: return {}
+    return run_coroutine(_resolve_prioritized_files(prioritized_candidates, verify, max_concurrency, use_listings, ttl))
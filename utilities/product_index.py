@@ -0,0 +1,149 @@
+import os
+import re
+import json
+import hashlib
+import datetime
+
+from atomicwrites import atomic_write
+
+INDEX_ROOT = os.path.join('TEMP','index')
+
+GPS_ZERO_EPOCH = datetime.datetime(1980, 1, 6)
+
+# (product type, regular expression, groups layout)
+PRODUCT_NAME_PATTERNS = [
+    ('ionex', re.compile(r'^(\w{3})0\w{3}\w{3}_(\d{4})(\d{3})0000_01D_\d{2}H_GIM\.INX$'), 'agency,year,doy'),
+    ('ionex', re.compile(r'^(\w+?)g(\d{3})0\.(\d{2})i$'), 'agency,doy,yy'),
+    ('sp3', re.compile(r'^(\w{3})0\w{3}\w{3}_(\d{4})(\d{3})0000_01D_\d{2}M_ORB\.SP3$'), 'agency,year,doy'),
+    ('sp3', re.compile(r'^(\w{3})(\d{4})(\d)\.sp3$'), 'agency,week,dow'),
+    ('clk', re.compile(r'^(\w{3})(\d{4})(\d)\.clk_30s$'), 'agency,week,dow'),
+    ('rinex', re.compile(r'^(\w{4})(\d{3})0\.(\d{2})o$'), 'agency,doy,yy'),
+]
+COMPRESSED_SUFFIX = re.compile(r'\.(Z|gz)$')
+
+
+def classify_product_name(file_name):
+    '''
+    Returns (product type, agency, date) of a product file name, None for unknown names.
+    Compressed products (.Z / .gz) classify like their content.
+    '''
+    file_name = COMPRESSED_SUFFIX.sub('', file_name)
+    for product_type, reg, layout in PRODUCT_NAME_PATTERNS:
+        match = reg.match(file_name)
+        if match is None: continue
+        groups = dict(zip(layout.split(','), match.groups()))
+        agency = groups['agency'].lower()
+        if 'week' in groups:
+            date = GPS_ZERO_EPOCH + datetime.timedelta(days=int(groups['week']) * 7 + int(groups['dow']))
+        else:
+            year = int(groups['year']) if 'year' in groups else 2000 + int(groups['yy'])
+            date = datetime.datetime(year, 1, 1) + datetime.timedelta(days=int(groups['doy']) - 1)
+        return product_type, agency, date
+    return None
+
+
+class ProductIndex(object):
+    '''
+    Persistent index of a product folder (ION/, SP3/, CLK/, RNX/).
+
+    The folder is scanned once and the index is saved under TEMP/index together with
+    the folder mtime, later runs reuse it until something else changes the folder.
+    Downloads register their files with add(), queries are dictionary lookups.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(INDEX_ROOT, '{}.json'.format(hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()))
+        self.names = {}
+        self.products = {}
+        self.mtime = None
+        self.refresh()
+
+    def _directory_mtime(self):
+        try:
+            return os.stat(self.directory).st_mtime_ns
+        except OSError:
+            return None
+
+    def refresh(self):
+        '''
+        Reloads the saved index, rescans the folder only when its mtime changed
+        '''
+        mtime = self._directory_mtime()
+        if mtime is not None and mtime == self.mtime: return
+
+        names = None
+        try:
+            with open(self.index_path) as f:
+                saved = json.load(f)
+            if saved.get('directory') == os.path.abspath(self.directory) and saved.get('mtime') == mtime:
+                names = saved['names']
+        except (OSError, ValueError):
+            pass
+
+        if names is None:
+            names = []
+            if mtime is not None:
+                with os.scandir(self.directory) as entries:
+                    names = [entry.name for entry in entries if entry.is_file()]
+            self.mtime = mtime
+            self._build(names)
+            self.save()
+        else:
+            self.mtime = mtime
+            self._build(names)
+
+    def _build(self, names):
+        self.names = {}
+        self.products = {}
+        for name in names:
+            self._insert(name)
+
+    def _insert(self, name):
+        path = os.path.join(self.directory, name)
+        self.names[name] = path
+        product = classify_product_name(name)
+        if product is not None:
+            self.products.setdefault(product, {})[name] = path
+
+    def save(self):
+        os.makedirs(INDEX_ROOT, exist_ok=True)
+        with atomic_write(self.index_path, overwrite=True) as f:
+            json.dump({'directory': os.path.abspath(self.directory), 'mtime': self.mtime, 'names': sorted(self.names)}, f)
+
+    def add(self, file_paths):
+        '''
+        Registers freshly downloaded files (None entries are ignored)
+        '''
+        if isinstance(file_paths, str): file_paths = [file_paths]
+        added = False
+        for file_path in file_paths:
+            if file_path is None or not os.path.isfile(file_path): continue
+            self._insert(os.path.basename(file_path))
+            added = True
+        if added:
+            self.mtime = self._directory_mtime()
+            self.save()
+
+    def path(self, file_name):
+        return self.names.get(file_name)
+
+    def __contains__(self, file_name):
+        return file_name in self.names
+
+    def first_available(self, prioritized_names):
+        '''
+        (priority, path) of the first name present in the folder, (None, None) if none is
+        '''
+        for priority, file_name in enumerate(prioritized_names):
+            path = self.names.get(file_name)
+            if path is not None:
+                return priority, path
+        return None, None
+
+    def lookup(self, product_type, agency, date):
+        '''
+        {file name: path} of every indexed product of that type, agency and date
+        '''
+        date = datetime.datetime(date.year, date.month, date.day)
+        return dict(self.products.get((product_type, agency.lower(), date), {}))
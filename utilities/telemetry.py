@@ -0,0 +1,185 @@
+import os
+import csv
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+METRICS_DIR = os.path.join('TEMP','metrics')
+METRICS_FORMAT = 'jsonl'            # or 'csv' (fetch rows only, HEAD latency merged in)
+RUNS_LOG = os.path.join(METRICS_DIR, 'runs.jsonl')
+PRINT_SUMMARY = False               # the summary is always logged (INFO), True also prints it
+
+FETCH_FIELDS = ('url', 'file_path', 'status', 'http_status', 'attempts', 'head_latency', 'queue_time', 'ttfb',
+                'transfer_time', 'compressed_bytes', 'decompress_time', 'decompressed_bytes', 'started')
+
+
+class FetchRecord(object):
+    '''
+    What happened to one file of a download run.
+
+    status is 'ok', 'cached' (already on disk), 'missing' (not on the server),
+    'failed' (every attempt failed) or 'corrupt' (did not decompress).
+    Times are seconds, ttfb and transfer_time are those of the last attempt.
+    '''
+    __slots__ = FETCH_FIELDS + ('queued',)
+
+    def __init__(self, url, file_path):
+        for field in self.__slots__:
+            setattr(self, field, None)
+        self.url = url
+        self.file_path = file_path
+        self.attempts = 0
+        self.compressed_bytes = 0
+        self.started = time.time()
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in FETCH_FIELDS}
+
+
+class TelemetryRun(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.fetches = []
+        self.events = []            # HEAD probes and folder listings
+        self.head_latency = {}
+
+    def new_fetch(self, url, file_path):
+        record = FetchRecord(url, file_path)
+        with self.lock:
+            self.fetches.append(record)
+        return record
+
+    def observe(self, event, url, latency, status, **extra):
+        with self.lock:
+            self.events.append(dict(event=event, url=url, latency=latency, status=status, time=time.time(), **extra))
+            if event == 'head':
+                self.head_latency[url] = latency
+
+    def summary(self):
+        wall = time.time() - self.started
+        fetches = [r for r in self.fetches if r.status != 'cached']
+        statuses = {}
+        for record in self.fetches:
+            statuses[record.status] = statuses.get(record.status, 0) + 1
+        first_fetch = min((r.started for r in fetches), default=time.time())
+
+        def total(field):
+            return sum(getattr(r, field) or 0 for r in fetches)
+
+        ttfbs = sorted(r.ttfb for r in fetches if r.ttfb is not None)
+        return {
+            'name': self.name,
+            'started': self.started,
+            'wall_time': wall,
+            # before the first transfer: folder listings, HEAD probes and local planning
+            'planning_time': max(0.0, min(first_fetch, self.started + wall) - self.started),
+            'files': len(self.fetches),
+            'statuses': statuses,
+            'attempts': total('attempts'),
+            'retries': sum(max(0, (r.attempts or 0) - 1) for r in fetches),
+            'head_requests': sum(1 for e in self.events if e['event'] == 'head'),
+            'listing_requests': sum(1 for e in self.events if e['event'] == 'listing' and not e.get('cached')),
+            'queue_time': total('queue_time'),
+            'ttfb_time': total('ttfb'),
+            'ttfb_p50': ttfbs[len(ttfbs) // 2] if ttfbs else None,
+            'ttfb_p95': ttfbs[int(len(ttfbs) * 0.95)] if ttfbs else None,
+            'transfer_time': total('transfer_time'),
+            'decompress_time': total('decompress_time'),
+            'compressed_bytes': total('compressed_bytes'),
+            'decompressed_bytes': total('decompressed_bytes'),
+        }
+
+    def write(self, summary):
+        '''
+        Writes the per-file records next to the other runs and appends the summary to runs.jsonl
+        '''
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))
+        path = os.path.join(METRICS_DIR, '{}_{}_{}.{}'.format(self.name, stamp, os.getpid(), METRICS_FORMAT))
+
+        rows = []
+        for record in self.fetches:
+            row = record.as_dict()
+            if row['head_latency'] is None:
+                row['head_latency'] = self.head_latency.get(record.url)
+            rows.append(row)
+
+        with open(path, 'w', newline='') as f:
+            if METRICS_FORMAT == 'csv':
+                writer = csv.DictWriter(f, fieldnames=FETCH_FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    f.write(json.dumps(dict(event='fetch', **row)) + '\n')
+                for event in self.events:
+                    f.write(json.dumps(event) + '\n')
+
+        with open(RUNS_LOG, 'a') as f:
+            f.write(json.dumps(dict(summary, metrics_file=path)) + '\n')
+        return path
+
+
+def format_summary(summary):
+    mb = 1e6
+    lines = [
+        '{name}: {files} files {statuses} in {wall_time:.1f}s'.format(**summary),
+        '    planning {planning_time:.2f}s ({listing_requests} listings, {head_requests} HEAD)'.format(**summary),
+        '    network  ttfb {ttfb_time:.2f}s transfer {transfer_time:.2f}s queued {queue_time:.2f}s, {attempts} attempts ({retries} retries)'.format(**summary),
+        '    decompression {:.2f}s, {:.2f} MB -> {:.2f} MB'.format(summary['decompress_time'],
+                                                                  summary['compressed_bytes'] / mb, summary['decompressed_bytes'] / mb),
+    ]
+    return '\n'.join(lines)
+
+
+_LOCK = threading.Lock()
+_CURRENT = None
+
+
+def current_run():
+    return _CURRENT
+
+
+def new_fetch(url, file_path):
+    '''
+    Record of one fetch in the active run, a detached one when no run is active
+    '''
+    run = _CURRENT
+    if run is None: return FetchRecord(url, file_path)
+    return run.new_fetch(url, file_path)
+
+
+def observe(event, url, latency, status, **extra):
+    run = _CURRENT
+    if run is not None: run.observe(event, url, latency, status, **extra)
+
+
+@contextmanager
+def telemetry_run(name):
+    '''
+    Collects the fetches made inside it, writes them to TEMP/metrics and logs a summary at the end.
+    Nested runs (download_campaign calling the planners) fold into the outer one.
+
+    Usable as a decorator: @telemetry_run('download_clk')
+    '''
+    global _CURRENT
+    with _LOCK:
+        outer = _CURRENT is None
+        if outer: _CURRENT = TelemetryRun(name)
+        run = _CURRENT
+    try:
+        yield run
+    finally:
+        if outer:
+            with _LOCK:
+                _CURRENT = None
+            summary = run.summary()
+            run.write(summary)
+            text = format_summary(summary)
+            logging.info(text)
+            if PRINT_SUMMARY: print(text)
@@ -0,0 +1,296 @@
+import ssl
+import time
+import random
+import socket
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlsplit
+
+import aiohttp
+
+HOST_INITIAL_LIMIT = 4              # concurrent requests a host starts with
+HOST_MIN_LIMIT = 1
+HOST_MAX_LIMIT = 16
+LATENCY_EWMA_ALPHA = 0.2
+LATENCY_CONGESTION_FACTOR = 3.0     # response latency above 3x the best seen counts as congestion
+CIRCUIT_FAILURE_THRESHOLD = 5       # consecutive failures that pause a host
+CIRCUIT_COOLDOWN = 60.0             # seconds a paused host gets before a trial request
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ServerBusy(Exception):
+    '''
+    Throttling or 5xx answer, worth retrying after a backoff
+    '''
+    def __init__(self, status, retry_after=None):
+        super().__init__(status)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def raise_for_busy(status, headers):
+    if status not in RETRY_STATUSES: return
+    retry_after = None
+    try:
+        retry_after = float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        pass
+    raise ServerBusy(status, retry_after)
+
+
+def backoff_delay(attempt, retry_after=None):
+    '''
+    Exponential backoff with full jitter, the server's Retry-After wins when given
+    '''
+    if retry_after is not None:
+        return min(BACKOFF_CAP, retry_after)
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class HostStats(object):
+    '''
+    What the current process learned about one archive host: its AIMD concurrency
+    limit, smoothed response latency and circuit breaker state.
+    '''
+
+    def __init__(self, host):
+        self.host = host
+        self.limit = float(HOST_INITIAL_LIMIT)
+        self.ewma_latency = None
+        self.best_latency = None
+        self.failures = 0
+        self.open_until = 0.0
+
+    def observe_latency(self, latency):
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency = LATENCY_EWMA_ALPHA * latency + (1 - LATENCY_EWMA_ALPHA) * self.ewma_latency
+        if self.best_latency is None or self.ewma_latency < self.best_latency:
+            self.best_latency = self.ewma_latency
+
+        if self.ewma_latency > LATENCY_CONGESTION_FACTOR * self.best_latency:
+            self.limit = max(HOST_MIN_LIMIT, self.limit * 0.75)
+        else:
+            self.limit = min(HOST_MAX_LIMIT, self.limit + 1.0 / self.limit)
+
+    def record(self, ok):
+        if ok:
+            self.failures = 0
+            return
+        self.failures += 1
+        self.limit = max(HOST_MIN_LIMIT, self.limit / 2)
+        if self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            logging.warning('{} keeps failing, pausing it for {:.0f}s'.format(self.host, CIRCUIT_COOLDOWN))
+            self.open_until = time.monotonic() + CIRCUIT_COOLDOWN
+            # half open afterwards, a single failed trial pauses the host again
+            self.failures = CIRCUIT_FAILURE_THRESHOLD - 1
+            self.limit = HOST_MIN_LIMIT
+
+    def circuit_wait(self):
+        return max(0.0, self.open_until - time.monotonic())
+
+
+_HOST_STATS = {}
+
+
+def host_stats(url):
+    host = urlsplit(url).hostname
+    stats = _HOST_STATS.get(host)
+    if stats is None:
+        stats = _HOST_STATS[host] = HostStats(host)
+    return stats
+
+
+def latency_trace_config():
+    '''
+    aiohttp hooks feeding the time to response headers into the host stats
+    '''
+    async def on_request_start(session, context, params):
+        context.start = time.monotonic()
+
+    async def on_request_end(session, context, params):
+        host_stats(str(params.url)).observe_latency(time.monotonic() - context.start)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+class _HostGate(object):
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            while True:
+                wait = self.stats.circuit_wait()
+                if wait > 0:
+                    try:
+                        await asyncio.wait_for(self.condition.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < max(HOST_MIN_LIMIT, int(self.stats.limit)):
+                    break
+                await self.condition.wait()
+            self.in_flight += 1
+
+    async def release(self, ok):
+        self.stats.record(ok)
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+
+class Throttler(object):
+    '''
+    Global cap on requests in flight plus one adaptive gate per host.
+
+    Create it inside the running event loop; the learned host stats outlive it.
+    '''
+
+    def __init__(self, max_concurrency):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.gates = {}
+
+    def gate(self, url):
+        stats = host_stats(url)
+        gate = self.gates.get(stats.host)
+        if gate is None:
+            gate = self.gates[stats.host] = _HostGate(stats)
+        return gate
+
+    @asynccontextmanager
+    async def slot(self, url, failures):
+        # the host gate comes first, a paused host must not hold global slots
+        gate = self.gate(url)
+        await gate.acquire()
+        ok = False
+        try:
+            async with self.semaphore:
+                yield
+            ok = True
+        except failures:
+            raise
+        except Exception:
+            # e.g. a missing file, the host itself answered fine
+            ok = True
+            raise
+        finally:
+            await gate.release(ok)
+
+
+class _SyncHostGate(object):
+    '''
+    Blocking _HostGate for threads: at most int(stats.limit) requests in flight to the
+    host, none while its circuit is open
+    '''
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait = self.stats.circuit_wait()
+                if wait > 0:
+                    self.condition.wait(timeout=wait)
+                    continue
+                if self.in_flight < max(HOST_MIN_LIMIT, int(self.stats.limit)):
+                    break
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, ok):
+        with self.condition:
+            self.stats.record(ok)
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+
+_SYNC_GATES = {}
+_SYNC_GATES_LOCK = threading.Lock()
+
+
+def sync_gate(url):
+    stats = host_stats(url)
+    with _SYNC_GATES_LOCK:
+        gate = _SYNC_GATES.get(stats.host)
+        # a new gate when the host stats were reset
+        if gate is None or gate.stats is not stats:
+            gate = _SYNC_GATES[stats.host] = _SyncHostGate(stats)
+    return gate
+
+
+@contextmanager
+def host_slot_sync(url, failures):
+    '''
+    Holds one of the host's slots for a blocking request, failures count against the host
+    '''
+    gate = sync_gate(url)
+    gate.acquire()
+    ok = False
+    try:
+        yield
+        ok = True
+    except failures:
+        raise
+    except Exception:
+        # e.g. a missing file, the host itself answered fine
+        ok = True
+        raise
+    finally:
+        gate.release(ok)
+
+
+# socket level failures, other OSErrors (ENOSPC, EACCES writing a file) are local and not the host's fault
+NETWORK_ERRORS = (ConnectionError, TimeoutError, socket.timeout, socket.gaierror, ssl.SSLError)
+ASYNC_TRANSIENT_ERRORS = (ServerBusy, aiohttp.ClientError, asyncio.TimeoutError) + NETWORK_ERRORS
+
+
+async def retrying(throttler, url, attempt, n_attempts):
+    '''
+    Awaits attempt() through the host gate, retrying transient failures with backoff.
+    The last transient error is raised when every attempt failed.
+    '''
+    for n in range(n_attempts):
+        retry_after = None
+        try:
+            async with throttler.slot(url, ASYNC_TRANSIENT_ERRORS):
+                return await attempt()
+        except ServerBusy as e:
+            retry_after = e.retry_after
+            if n == n_attempts - 1: raise
+        except ASYNC_TRANSIENT_ERRORS:
+            if n == n_attempts - 1: raise
+        await asyncio.sleep(backoff_delay(n, retry_after))
+
+
+def retrying_sync(url, attempt, n_attempts, transient_errors):
+    '''
+    Blocking counterpart of retrying for the requests based code paths: every attempt
+    holds a per-host slot shared by all threads (legacy FTPS workers), the backoff does not
+    '''
+    transient_errors = (ServerBusy,) + tuple(transient_errors)
+    for n in range(n_attempts):
+        retry_after = None
+        try:
+            with host_slot_sync(url, transient_errors):
+                return attempt()
+        except ServerBusy as e:
+            retry_after = e.retry_after
+            if n == n_attempts - 1: raise
+        except transient_errors:
+            if n == n_attempts - 1: raise
+        time.sleep(backoff_delay(n, retry_after))
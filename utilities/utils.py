@@ -17,6 +17,9 @@ from typing import List
 
 from multiprocessing import Pool, cpu_count
 
+from utilities.network import fetch_and_decompress, download_files, resolve_prioritized_files, filter_available_files, compressed_path, MAX_CONCURRENT_DOWNLOADS
+from utilities.telemetry import telemetry_run
+
 from requests.packages import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -32,6 +35,11 @@ TEMP_root = 'TEMP'
 
 VERIFY_REST_SECURITY = False
 
+# archive roots, the plan_* functions read them at call time so a mirror can be swapped in
+CDDIS_PRODUCTS_URL = 'https://cddis.nasa.gov/archive/gnss/products'
+CDDIS_IONEX_URL = CDDIS_PRODUCTS_URL + '/ionex'
+GARNER_RINEX_URL = 'https://garner.ucsd.edu/archive/garner/rinex'
+
 
 def gLab_output_to_numpy(output_file):
     NEU_START,NEU_END = 17,20
@@ -85,50 +93,30 @@ def date_to_doy(date):
 
 
 def download_and_save_file(url,file_path):
-    def download(url):
-        # filename = url.split('/')[-1]
+    # streams straight from the socket through the decompressor into file_path
+    return fetch_and_decompress(url,file_path,verify=VERIFY_REST_SECURITY)
         
-        response = requests.head(url,verify=VERIFY_REST_SECURITY)
-        if response.status_code != 200:
-            # raise Exception('HTTP error ' + str(response.status_code) +" "+ str(url))
-            return None
-        n_attepts = 3
-        response = None
-        for n in range(n_attepts):
-            try:
-                response = requests.get(url,verify=VERIFY_REST_SECURITY)
-            except:
-                # print(f'Error downloading {url}')
-                pass
-            if response: break
-        if response is None: return None
-        buf = BytesIO()
-        for chunk in response.iter_content(chunk_size=1000):
-                buf.write(chunk)
-        return buf.getvalue()
-    
-    # print(file_path,os.path.isfile(file_path),url)
-    if os.path.isfile(file_path): return file_path
-    data_zipped = download(url)
-    if data_zipped is None: 
-        return None
-    
+def is_downloaded(file_path,data_dict):
+    # extracted, or kept compressed (keep_compressed downloads)
+    return os.path.isfile(file_path) or os.path.isfile(compressed_path(file_path,data_dict['url']))
 
-    ephem_bytes = hatanaka.decompress(data_zipped)
-    with atomic_write(file_path, mode='wb', overwrite=True) as f:
-        f.write(ephem_bytes)
+def log_missing_files(files_dict,log_filename):
+    missing_lines = ["missing : {} {}\n".format(data_dict['date'],data_dict['url'])
+                     for file_path,data_dict in files_dict.items() if not is_downloaded(file_path,data_dict)]
+    if len(missing_lines) == 0: return
 
-    return file_path
-        
-def download_clk(dates_list=[],agencies_list=['igs'],download_folder=CLK_root,log_filename='download_clk.log'):
+    os.makedirs(TEMP_root,exist_ok=True)
+    log_filename = os.path.join(TEMP_root,log_filename)
+    with open(log_filename,'a') as logfile:
+        logfile.writelines(missing_lines)
+
+def plan_clk(dates_list=[],agencies_list=['igs'],download_folder=CLK_root):
 
     base_urls = [
-        'https://cddis.nasa.gov/archive/gnss/products'
+        CDDIS_PRODUCTS_URL
         # 'https://urs.earthdata.nasa.gov/archive/gnss/products'
     ]
 
-    # download_folder_zip = os.path.join(download_folder,'zip')
-
     files_to_download_dict = {}
 
     for agency in agencies_list:
@@ -146,42 +134,29 @@ def download_clk(dates_list=[],agencies_list=['igs'],download_folder=CLK_root,lo
             if os.path.isfile(extracted_file_path):
                 continue
             else:
-                #TODO download the file
                 for base_url in base_urls:
                     url = '{}/{}/{}'.format(base_url,gps_week,Z_file_name)
-                    # print(url)
                     files_to_download_dict[extracted_file_path] = {'url':url,'date':date}
-                
-    urls_to_download = [value['url'] for value in files_to_download_dict.values()]
 
-    # print("There are {} CPUs on this machine ".format(cpu_count()))
-    pool = Pool(MAX_N_PROCESSES)
-    results = pool.starmap(download_and_save_file,zip(urls_to_download,list(files_to_download_dict.keys())))
-    pool.close()
-    pool.join()
+    return files_to_download_dict
 
-    # for url,file_path in zip(urls_to_download,list(files_to_download_dict.keys())):
-    #     download_and_save_file(url,file_path)
+@telemetry_run('download_clk')
+def download_clk(dates_list=[],agencies_list=['igs'],download_folder=CLK_root,log_filename='download_clk.log',max_concurrency=MAX_CONCURRENT_DOWNLOADS):
 
-    os.makedirs(TEMP_root,exist_ok=True)
-    log_filename = os.path.join(TEMP_root,log_filename)
+    files_to_download_dict = plan_clk(dates_list,agencies_list,download_folder)
 
-    for file_path,data_dict in files_to_download_dict.items():
-        if not os.path.isfile(file_path):
-            with open(log_filename,'a') as logfile:    
-                logfile.writelines("missing : {} {}\n".format(data_dict['date'],data_dict['url']))
-            
+    # names missing from the (cached) folder listings are not requested at all
+    files_available_dict = filter_available_files(files_to_download_dict,verify=VERIFY_REST_SECURITY,max_concurrency=max_concurrency)
+    results = download_files(files_available_dict,verify=VERIFY_REST_SECURITY,max_concurrency=max_concurrency)
 
+    log_missing_files(files_to_download_dict,log_filename)
 
-             
-def download_rinex(station_name,dates_list=[],download_folder=RNX_root,log_filename='download_rinex.log'):
+def plan_rinex(station_name,dates_list=[],download_folder=RNX_root):
 
     base_urls = [
-        'https://garner.ucsd.edu/archive/garner/rinex'
+        GARNER_RINEX_URL
     ]
 
-    # download_folder_zip = os.path.join(download_folder,'zip')
-
     files_to_download_dict = {}
 
     for date in dates_list:
@@ -191,44 +166,28 @@ def download_rinex(station_name,dates_list=[],download_folder=RNX_root,log_filen
         Z_file_name = '{}.Z'.format(rinex_compressed_name)
         file_name = rinex_decopressed_name
 
-        # print(Z_file_name,file_name)
-
         extracted_file_path = os.path.join(download_folder,file_name)
         os.makedirs(os.path.dirname(extracted_file_path), exist_ok=True)
 
-        # if os.path.isfile(extracted_file_path):
-            # continue
-        # else:
-        #TODO download the file
+        # completed downloads are skipped, interrupted ones resume from their .part
+        if os.path.isfile(extracted_file_path):
+            continue
         for base_url in base_urls:
             url = '{}/{}/{:03d}/{}'.format(base_url,year,day,Z_file_name)
-            print(url)
             files_to_download_dict[extracted_file_path] = {'url':url,'date':date}
-                
-    urls_to_download = [value['url'] for value in files_to_download_dict.values()]
 
-    # print(urls_to_download)
+    return files_to_download_dict
 
-    # print("There are {} CPUs on this machine ".format(cpu_count()))
-    pool = Pool(MAX_N_PROCESSES)
-    results = pool.starmap(download_and_save_file,zip(urls_to_download,list(files_to_download_dict.keys())))
-    # print(results)
-    pool.close()
-    pool.join()
+@telemetry_run('download_rinex')
+def download_rinex(station_name,dates_list=[],download_folder=RNX_root,log_filename='download_rinex.log',max_concurrency=MAX_CONCURRENT_DOWNLOADS):
 
-    # for url,file_path in zip(urls_to_download,list(files_to_download_dict.keys())):
-    #     download_and_save_file(url,file_path)
+    files_to_download_dict = plan_rinex(station_name,dates_list,download_folder)
+    for data_dict in files_to_download_dict.values():
+        print(data_dict['url'])
 
-    os.makedirs(TEMP_root,exist_ok=True)
-    log_filename = os.path.join(TEMP_root,log_filename)
+    results = download_files(files_to_download_dict,verify=VERIFY_REST_SECURITY,max_concurrency=max_concurrency)
 
-    for file_path,data_dict in files_to_download_dict.items():
-        if not os.path.isfile(file_path):
-            with open(log_filename,'a') as logfile:
-                # log_lines = logfile.readlines()
-                line = "missing : {} {}\n".format(data_dict['date'],data_dict['url'])
-                # if not line in log_lines : 
-                logfile.writelines(line)
+    log_missing_files(files_to_download_dict,log_filename)
 
 def generate_dates(year,n_contious_dates,n_generations=1,up_to : datetime.datetime = None):
 
@@ -309,68 +268,45 @@ def date_to_ionex_name_v2(date,agency):
 
     return zip_names,names,date.year,dt.days
 
-def download_ionex_v2(dates_list=[],agencies_list=['igs','ckm'],download_folder=ION_root,log_filename='download_ionex.log'):
+def plan_ionex_v2(dates_list=[],agencies_list=['igs','ckm'],download_folder=ION_root):
     base_urls = [
-        'https://cddis.nasa.gov/archive/gnss/products/ionex'
+        CDDIS_IONEX_URL
     ]
 
-    # download_folder_zip = os.path.join(download_folder,'zip')
-
     files_to_download_dict = {}
     for agency in agencies_list:
         for date in dates_list:
 
-            # _name,year,day = date_to_ionex_name(date,agency)
-            # print(date,agency)
             zip_names,file_names,year,day = date_to_ionex_name_v2(date,agency)
 
-            # print(zip_names,file_names)
-
             for zip_name,file_name in zip(zip_names,file_names):
 
                 if agency == 'ckm':
                     zip_name = 'topex/{}'.format(zip_name)
 
-                # print(zip_name,file_name)
-
                 extracted_file_path = os.path.join(download_folder,file_name)
                 os.makedirs(os.path.dirname(extracted_file_path), exist_ok=True)
 
-                # if os.path.isfile(extracted_file_path):
-                    # continue
-                # else:
-                #TODO download the file
                 for base_url in base_urls:
                     url = '{}/{}/{:03d}/{}'.format(base_url,year,day,zip_name)
-
-                    # print(extracted_file_path,url)
                     files_to_download_dict[extracted_file_path] = {'url':url,'date':date}
-                
-    urls_to_download = [value['url'] for value in files_to_download_dict.values()]
 
-    # print(files_to_download_dict)
-    # print("There are {} CPUs on this machine ".format(cpu_count()))
-    pool = Pool(MAX_N_PROCESSES)
-    # pool = Pool(1)
-    results = pool.starmap(download_and_save_file,zip(urls_to_download,list(files_to_download_dict.keys())))
-    # print(results)
-    # rename_ionex_to_old_format(results)
-    pool.close()
-    pool.join()
+    return files_to_download_dict
 
-    # for url,file_path in zip(urls_to_download,list(files_to_download_dict.keys())):
-    #     download_and_save_file(url,file_path)
+@telemetry_run('download_ionex_v2')
+def download_ionex_v2(dates_list=[],agencies_list=['igs','ckm'],download_folder=ION_root,log_filename='download_ionex.log',max_concurrency=MAX_CONCURRENT_DOWNLOADS,
+                      keep_compressed=False):
+    '''
+    keep_compressed saves the products as the .gz / .Z the archive serves, the IONEX readers open them directly
+    '''
+    files_to_download_dict = plan_ionex_v2(dates_list,agencies_list,download_folder)
 
-    os.makedirs(TEMP_root,exist_ok=True)
-    log_filename = os.path.join(TEMP_root,log_filename)
+    # names missing from the (cached) folder listings are not requested at all
+    files_available_dict = filter_available_files(files_to_download_dict,verify=VERIFY_REST_SECURITY,max_concurrency=max_concurrency)
+    results = download_files(files_available_dict,verify=VERIFY_REST_SECURITY,max_concurrency=max_concurrency,keep_compressed=keep_compressed)
+    # rename_ionex_to_old_format(results)
 
-    for file_path,data_dict in files_to_download_dict.items():
-        if not os.path.isfile(file_path):
-            with open(log_filename,'a') as logfile:
-                # log_lines = logfile.readlines()
-                line = "missing : {} {}\n".format(data_dict['date'],data_dict['url'])
-                # if not line in log_lines : 
-                logfile.writelines(line)
+    log_missing_files(files_to_download_dict,log_filename)
 
 def date_to_ionex_name(date,agency):
     '''
@@ -383,12 +319,13 @@ def date_to_ionex_name(date,agency):
     # decompressed = '{}g{:03d}0.{:02d}o'.format(agency,dt.days,_year)
     return name,date.year,dt.days
 
-def download_ionex(dates_list=[],agencies_list=['igs','ckm'],download_folder=ION_root,log_filename='download_ionex.log'):
+@telemetry_run('download_ionex')
+def download_ionex(dates_list=[],agencies_list=['igs','ckm'],download_folder=ION_root,log_filename='download_ionex.log',max_concurrency=MAX_CONCURRENT_DOWNLOADS):
     '''
     Deprecated
     '''
     base_urls = [
-        'https://cddis.nasa.gov/archive/gnss/products/ionex'
+        CDDIS_IONEX_URL
     ]
 
     # download_folder_zip = os.path.join(download_folder,'zip')
@@ -422,31 +359,16 @@ def download_ionex(dates_list=[],agencies_list=['igs','ckm'],download_folder=ION
                 
                 files_to_download_dict[extracted_file_path] = {'url':url,'date':date}
                 
-    urls_to_download = [value['url'] for value in files_to_download_dict.values()]
 
     # print(urls_to_download)
 
     # print("There are {} CPUs on this machine ".format(cpu_count()))
-    pool = Pool(MAX_N_PROCESSES)
-    # pool = Pool(1)
-    results = pool.starmap(download_and_save_file,zip(urls_to_download,list(files_to_download_dict.keys())))
-    # print(results)
-    pool.close()
-    pool.join()
+    results = download_files(files_to_download_dict,verify=VERIFY_REST_SECURITY,max_concurrency=max_concurrency)
 
     # for url,file_path in zip(urls_to_download,list(files_to_download_dict.keys())):
     #     download_and_save_file(url,file_path)
 
-    os.makedirs(TEMP_root,exist_ok=True)
-    log_filename = os.path.join(TEMP_root,log_filename)
-
-    for file_path,data_dict in files_to_download_dict.items():
-        if not os.path.isfile(file_path):
-            with open(log_filename,'a') as logfile:
-                # log_lines = logfile.readlines()
-                line = "missing : {} {}\n".format(data_dict['date'],data_dict['url'])
-                # if not line in log_lines : 
-                logfile.writelines(line)
+    log_missing_files(files_to_download_dict,log_filename)
 
 ##################################
 #             SP3                    
@@ -495,72 +417,59 @@ def prioritized_sp3_filenames(date):
 
     return zip_names,names
 
-def download_sp3_v2(dates_list=[],download_folder=SP3_root,log_filename='download_sp3.log'):
-
+def plan_sp3_v2(dates_list=[],download_folder=SP3_root):
+    '''
+    One prioritized candidate list per date, see resolve_prioritized_files
+    '''
     base_urls = [
-        'https://cddis.nasa.gov/archive/gnss/products'
+        CDDIS_PRODUCTS_URL
         # 'https://urs.earthdata.nasa.gov/archive/gnss/products'
     ]
 
-    # download_folder_zip = os.path.join(download_folder,'zip')
-
-    files_to_download_dict = {}
+    prioritized_candidates = []
 
     for date in dates_list:
 
+        candidates = []
         zip_names,names = prioritized_sp3_filenames(date)
         for Z_file_name,file_name in zip(zip_names,names):
 
             extracted_file_path = os.path.join(download_folder,file_name)
             os.makedirs(os.path.dirname(extracted_file_path), exist_ok=True)
 
+            # a local product of higher priority makes the remaining candidates redundant
             if os.path.isfile(extracted_file_path):
                 break
-                continue
             else:
-                #TODO download the file
-                file_url_exist = False
                 gps_week,gps_day = datetime_to_gpsweekday(date)
                 for base_url in base_urls:
                     url = '{}/{}/{}'.format(base_url,gps_week,Z_file_name)
-                    
-                    response = requests.head(url,verify=VERIFY_REST_SECURITY)
-                    if response.status_code == 200:
-                        files_to_download_dict[extracted_file_path] = {'url':url,'date':date}
-                        file_url_exist = True
-                        break
-                if file_url_exist: break
+                    candidates.append((extracted_file_path,{'url':url,'date':date}))
 
-    
-                
-    urls_to_download = [value['url'] for value in files_to_download_dict.values()]
+        prioritized_candidates.append(candidates)
 
-    # return urls_to_download
+    return prioritized_candidates
 
-    # print("There are {} CPUs on this machine ".format(cpu_count()))
-    pool = Pool(MAX_N_PROCESSES)
-    results = pool.starmap(download_and_save_file,zip(urls_to_download,list(files_to_download_dict.keys())))
-    # rename_sp3_to_old_format(results)
-    pool.close()
-    pool.join()
+@telemetry_run('download_sp3_v2')
+def download_sp3_v2(dates_list=[],download_folder=SP3_root,log_filename='download_sp3.log',max_concurrency=MAX_CONCURRENT_DOWNLOADS):
 
-    # for url,file_path in zip(urls_to_download,list(files_to_download_dict.keys())):
-    #     download_and_save_file(url,file_path)
+    prioritized_candidates = plan_sp3_v2(dates_list,download_folder)
 
-    os.makedirs(TEMP_root,exist_ok=True)
-    log_filename = os.path.join(TEMP_root,log_filename)
+    # all dates are probed at once, the highest priority hit of each date wins
+    files_to_download_dict = resolve_prioritized_files(prioritized_candidates,verify=VERIFY_REST_SECURITY,max_concurrency=max_concurrency)
+
+    results = download_files(files_to_download_dict,verify=VERIFY_REST_SECURITY,max_concurrency=max_concurrency)
+    # rename_sp3_to_old_format(results)
 
-    for file_path,data_dict in files_to_download_dict.items():
-        if not os.path.isfile(file_path):
-            with open(log_filename,'a') as logfile:    
-                logfile.writelines("missing : {} {}\n".format(data_dict['date'],data_dict['url']))
+    log_missing_files(files_to_download_dict,log_filename)
 
-def download_sp3(dates_list=[],agencies_list=['igs'],download_folder=SP3_root,log_filename='download_sp3.log'):
+@telemetry_run('download_sp3')
+def download_sp3(dates_list=[],agencies_list=['igs'],download_folder=SP3_root,log_filename='download_sp3.log',max_concurrency=MAX_CONCURRENT_DOWNLOADS):
 
 
 
     base_urls = [
-        'https://cddis.nasa.gov/archive/gnss/products'
+        CDDIS_PRODUCTS_URL
         # 'https://urs.earthdata.nasa.gov/archive/gnss/products'
     ]
 
@@ -589,24 +498,80 @@ def download_sp3(dates_list=[],agencies_list=['igs'],download_folder=SP3_root,lo
                     
                     files_to_download_dict[extracted_file_path] = {'url':url,'date':date}
                 
-    urls_to_download = [value['url'] for value in files_to_download_dict.values()]
 
     # print("There are {} CPUs on this machine ".format(cpu_count()))
-    pool = Pool(MAX_N_PROCESSES)
-    results = pool.starmap(download_and_save_file,zip(urls_to_download,list(files_to_download_dict.keys())))
-    pool.close()
-    pool.join()
+    results = download_files(files_to_download_dict,verify=VERIFY_REST_SECURITY,max_concurrency=max_concurrency)
 
     # for url,file_path in zip(urls_to_download,list(files_to_download_dict.keys())):
     #     download_and_save_file(url,file_path)
 
-    os.makedirs(TEMP_root,exist_ok=True)
-    log_filename = os.path.join(TEMP_root,log_filename)
+    log_missing_files(files_to_download_dict,log_filename)
+
+
+##################################
+#           CAMPAIGN                    
+##################################
+
+def plan_campaign(stations=[],dates_list=[],ionex_agencies_list=['igs','ckm'],product_types=[ION_root,SP3_root,CLK_root,RNX_root],
+                  clk_agencies_list=['igs'],max_concurrency=MAX_CONCURRENT_DOWNLOADS):
+    '''
+    Planning half of download_campaign, nothing is downloaded.
+
+    Returns (files_to_download_dict, files_available_dict), every planned file and the ones the
+    archives (listings, sp3 priority probes) actually have, both as {file_path:{'url','date'}}
+    '''
+    dates_list = sorted(set(dates_list))
+
+    files_to_download_dict = {}
+    if ION_root in product_types:
+        files_to_download_dict.update(plan_ionex_v2(dates_list,ionex_agencies_list))
+    if CLK_root in product_types:
+        files_to_download_dict.update(plan_clk(dates_list,clk_agencies_list))
+    if RNX_root in product_types:
+        for station in sorted(set(stations)):
+            files_to_download_dict.update(plan_rinex(station,dates_list))
+
+    # names missing from the (cached) folder listings are not requested at all
+    files_available_dict = filter_available_files(files_to_download_dict,verify=VERIFY_REST_SECURITY,max_concurrency=max_concurrency)
+
+    prioritized_candidates = plan_sp3_v2(dates_list) if SP3_root in product_types else []
+    files_available_dict.update(resolve_prioritized_files(prioritized_candidates,verify=VERIFY_REST_SECURITY,max_concurrency=max_concurrency))
+    # an sp3 date is reported by its highest priority candidate unless another one got resolved
+    for candidates in prioritized_candidates:
+        if len(candidates) == 0: continue
+        if not any(file_path in files_available_dict for file_path,_ in candidates):
+            file_path,data_dict = candidates[0]
+            files_to_download_dict[file_path] = data_dict
+    files_to_download_dict.update(files_available_dict)
+
+    return files_to_download_dict,files_available_dict
+
+@telemetry_run('download_campaign')
+def download_campaign(stations=[],dates_list=[],ionex_agencies_list=['igs','ckm'],product_types=[ION_root,SP3_root,CLK_root,RNX_root],
+                      clk_agencies_list=['igs'],log_filename='download_campaign.log',max_concurrency=MAX_CONCURRENT_DOWNLOADS,
+                      keep_compressed=False):
+    '''
+    Downloads every product a (stations x dates) campaign needs in one scheduled batch.
+
+    dates_list may repeat dates (overlapping date sequences), each unique file is planned once.
+    The agencies default to the ones of download_ionex_v2 (ionex_agencies_list) and download_clk
+    (clk_agencies_list), sp3 follows the priority list of download_sp3_v2.
+    keep_compressed leaves the products as the archive serves them (.Z / .gz).
+    Returns a report {'planned':[file paths],'downloaded':[file paths],'missing':{file_path:{'url','date'}}}
+    '''
+    files_to_download_dict,files_available_dict = plan_campaign(stations,dates_list,ionex_agencies_list,product_types,
+                                                                clk_agencies_list,max_concurrency)
+
+    results = download_files(files_available_dict,verify=VERIFY_REST_SECURITY,max_concurrency=max_concurrency,keep_compressed=keep_compressed)
+
+    log_missing_files(files_to_download_dict,log_filename)
 
-    for file_path,data_dict in files_to_download_dict.items():
-        if not os.path.isfile(file_path):
-            with open(log_filename,'a') as logfile:    
-                logfile.writelines("missing : {} {}\n".format(data_dict['date'],data_dict['url']))
+    report = {
+        'planned':list(files_to_download_dict.keys()),
+        'downloaded':[r for r in results if r is not None],
+        'missing':{file_path:data_dict for file_path,data_dict in files_to_download_dict.items() if not is_downloaded(file_path,data_dict)},
+    }
+    return report
 
 
 ##################################